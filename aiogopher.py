@@ -0,0 +1,117 @@
+# coding=utf-8
+#
+# Gophersnake: stand-alone Gopher client for modern desktops
+# Copyright 2016-2018 Felix Pleșoianu <https://felix.plesoianu.ro/>
+#
+# Offered under the MIT License; see gophersnake.py or LICENSE for full text.
+#
+# Asyncio Gopher client, for batch jobs (mirroring, link checking) that
+# need hundreds of requests in flight without a thread for each one.
+# Needs Python 3.7 or newer, as do gophermirror.py and gopherproxy.py.
+
+import asyncio
+
+read_size = 65536
+
+def _remaining(deadline):
+	if deadline == None:
+		return None
+	left = deadline - asyncio.get_running_loop().time()
+	if left <= 0:
+		raise asyncio.TimeoutError()
+	return left
+
+async def fetch_stream(selector, host, port, timeout=None):
+	"""Yield the response to selector in chunks as they arrive.
+
+	The timeout, in seconds, covers the whole request: connecting,
+	sending and reading up to the end of the response. Going past it
+	raises asyncio.TimeoutError. Cancelling the task closes the socket.
+	A selector given as bytes is sent exactly as it is.
+	"""
+	if timeout != None:
+		deadline = asyncio.get_running_loop().time() + timeout
+	else:
+		deadline = None
+	reader, writer = await asyncio.wait_for(
+		asyncio.open_connection(host, int(port)), _remaining(deadline))
+	try:
+		if not isinstance(selector, bytes):
+			selector = selector.encode()
+		writer.write(selector + b"\r\n")
+		await asyncio.wait_for(writer.drain(), _remaining(deadline))
+		while True:
+			data = await asyncio.wait_for(
+				reader.read(read_size), _remaining(deadline))
+			if not data:
+				break
+			yield data
+	finally:
+		writer.close()
+
+async def fetch(selector, host, port, timeout=None):
+	"""Return the whole response to selector as bytes."""
+	chunks = []
+	async for i in fetch_stream(selector, host, port, timeout):
+		chunks.append(i)
+	return b"".join(chunks)
+
+class Limiter(object):
+	"""Caps requests in flight on one event loop, overall and per host.
+
+	Use as "async with limiter.slot(host):" around each request. The
+	host slot is taken first, so a request held back by a busy host
+	doesn't also sit on one of the overall slots meanwhile.
+	"""
+	def __init__(self, limit=100, per_host=None):
+		self.limit = limit
+		# Made on first use; before 3.10, a semaphore made outside the
+		# loop that asyncio.run() starts would be tied to another one.
+		self.overall = None
+		self.per_host = per_host
+		self.hosts = {}
+
+	def slot(self, host):
+		return _Slot(self, host.lower())
+
+class _Slot(object):
+	def __init__(self, limiter, host):
+		self.limiter = limiter
+		self.host = host
+
+	async def __aenter__(self):
+		limiter = self.limiter
+		if limiter.overall == None:
+			limiter.overall = asyncio.Semaphore(limiter.limit)
+		if limiter.per_host != None:
+			if self.host not in limiter.hosts:
+				limiter.hosts[self.host] = asyncio.Semaphore(
+					limiter.per_host)
+			await limiter.hosts[self.host].acquire()
+		try:
+			await limiter.overall.acquire()
+		except BaseException:
+			self.release_host()
+			raise
+
+	async def __aexit__(self, *exc_info):
+		self.limiter.overall.release()
+		self.release_host()
+
+	def release_host(self):
+		if self.limiter.per_host != None:
+			self.limiter.hosts[self.host].release()
+
+async def fetch_many(requests, limit=100, timeout=None, per_host=None):
+	"""Fetch (selector, host, port) tuples with at most limit at once.
+
+	per_host, if given, also caps the requests to any single server.
+	Returns a list in the same order as requests, holding either the
+	response bytes or the exception that request failed with.
+	"""
+	limiter = Limiter(limit, per_host)
+	async def fetch_one(selector, host, port):
+		async with limiter.slot(host):
+			return await fetch(selector, host, port, timeout)
+	return await asyncio.gather(
+		*[fetch_one(*i) for i in requests], return_exceptions=True)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Gophersnake: stand-alone Gopher client for modern desktops
+# Copyright 2016-2018 Felix Pleșoianu <https://felix.plesoianu.ro/>
+#
+# Offered under the MIT License; see gophersnake.py or LICENSE for full text.
+#
+# Benchmarks for the protocol core, run against a stand-in Gopher server
+# on the loopback interface so the numbers don't depend on the network.
+# Results are printed as a table and can be saved as JSON for comparing
+# one version of Gophersnake against another.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import socketserver
+import threading
+
+import gopherlib
+
+block = b"0123456789abcdef" * 4096
+
+def menu_line(i, port):
+	return ("%sEntry number %d with a label\t/dir%d/item%d.txt\t"
+		"127.0.0.1\t%d\r\n" % ("01i"[i % 3], i, i // 100, i, port))
+
+def make_menu(count, port=70):
+	return "".join(menu_line(i, port) for i in range(count)).encode() \
+		+ b".\r\n"
+
+class StandInHandler(socketserver.StreamRequestHandler):
+	# Selectors: "body/<bytes>" sends that many bytes of filler, and
+	# "menu/<entries>" a synthetic menu with that many entries.
+	def handle(self):
+		selector = self.rfile.readline().strip().decode("latin_1")
+		kind, _, arg = selector.partition("/")
+		if kind == "body":
+			self.send_body(int(arg))
+		elif kind == "menu":
+			self.send_menu(int(arg))
+		else:
+			self.wfile.write(b"3Unknown selector\t\terror.host\t1\r\n.\r\n")
+
+	def send_body(self, size):
+		while size > 0:
+			self.wfile.write(block[:size])
+			size -= len(block)
+
+	def send_menu(self, count):
+		port = self.server.server_address[1]
+		for start in range(0, count, 1000):
+			lines = [menu_line(i, port)
+				for i in range(start, min(start + 1000, count))]
+			self.wfile.write("".join(lines).encode())
+		self.wfile.write(b".\r\n")
+
+class StandInServer(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+def start_server():
+	server = StandInServer(("127.0.0.1", 0), StandInHandler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+def best_of(fn, repeat):
+	# Fastest of several runs, the usual way to filter out noise.
+	times = []
+	for i in range(repeat):
+		start = time.time()
+		fn()
+		times.append(time.time() - start)
+	return min(times)
+
+class Suite(object):
+	def __init__(self, port, repeat):
+		self.port = port
+		self.repeat = repeat
+		self.results = []
+
+	def record(self, name, size, seconds, amount, unit):
+		seconds = max(seconds, 1e-9)
+		result = {"name": name, "size": size, "seconds": seconds,
+			"rate": amount / seconds, "unit": unit}
+		self.results.append(result)
+		print("%-24s %12d %10.4f s %14.1f %s" % (
+			name, size, seconds, result["rate"], unit))
+
+	def fetch(self, size):
+		def run():
+			received = 0
+			for i in gopherlib.fetch_data(
+					"body/%d" % size, "127.0.0.1", self.port):
+				received += len(i)
+			assert received == size
+		seconds = best_of(run, self.repeat)
+		self.record("fetch_data", size, seconds, size / 1048576.0, "MB/s")
+
+	def fetch_menu(self, count):
+		def run():
+			parser = gopherlib.MenuParser()
+			entries = gopherlib.Directory()
+			for i in gopherlib.fetch_data(
+					"menu/%d" % count, "127.0.0.1", self.port):
+				entries.extend(parser.feed(i))
+			assert len(entries) == count
+		seconds = best_of(run, self.repeat)
+		self.record("fetch+parse menu", count, seconds, count, "entries/s")
+
+	def parse(self, count):
+		data = make_menu(count)
+		seconds = best_of(lambda: gopherlib.parse_bytes(data), self.repeat)
+		self.record("parse_bytes", count, seconds, count, "entries/s")
+		lines = data.decode("latin_1").split("\r\n")
+		def run():
+			for i in lines:
+				gopherlib.str2entry(i)
+		seconds = best_of(run, self.repeat)
+		self.record("str2entry", count, seconds, count, "lines/s")
+
+	def snapshots(self, count):
+		entries = gopherlib.parse_bytes(make_menu(count))
+		directory = tempfile.mkdtemp()
+		try:
+			text = os.path.join(directory, "page.txt")
+			snap = os.path.join(directory, "page.gsnap")
+			seconds = best_of(
+				lambda: gopherlib.write_to_file(text, entries), self.repeat)
+			self.record("write_to_file", count, seconds, count, "entries/s")
+			seconds = best_of(
+				lambda: gopherlib.write_snapshot(snap, entries), self.repeat)
+			self.record("write_snapshot", count, seconds, count, "entries/s")
+			seconds = best_of(
+				lambda: list(gopherlib.parse_file(text)), self.repeat)
+			self.record("parse_file", count, seconds, count, "entries/s")
+			def run():
+				with gopherlib.Snapshot(snap) as snapshot:
+					list(snapshot)
+			seconds = best_of(run, self.repeat)
+			self.record("Snapshot, all", count, seconds, count, "entries/s")
+			# What opening a page costs: the first screenful.
+			def run():
+				with gopherlib.Snapshot(snap) as snapshot:
+					snapshot[:50]
+			seconds = best_of(run, self.repeat)
+			self.record("Snapshot, first 50", count, seconds,
+				min(count, 50), "entries/s")
+		finally:
+			shutil.rmtree(directory)
+
+	def urls(self, count):
+		entries = gopherlib.parse_bytes(make_menu(count))
+		def run():
+			for i in entries:
+				gopherlib.entry2url(i)
+		seconds = best_of(run, self.repeat)
+		self.record("entry2url", count, seconds, count, "urls/s")
+
+	def cache_hits(self, count):
+		cache = gopherlib.LRUCache(max_entries=count)
+		keys = ["gopher://127.0.0.1/1/dir%d" % i for i in range(count)]
+		for i in keys:
+			cache.put(i, b"x" * 100)
+		def run():
+			for i in keys:
+				cache.get(i)
+		seconds = best_of(run, self.repeat)
+		self.record("LRUCache.get hit", count, seconds, count, "gets/s")
+
+	def disk_cache_hits(self, size):
+		directory = tempfile.mkdtemp()
+		try:
+			disk = gopherlib.DiskCache(directory)
+			disk.put("gopher://127.0.0.1/0/file", block[:1] * size)
+			def run():
+				data = disk.get("gopher://127.0.0.1/0/file")
+				assert len(data) == size
+			seconds = best_of(run, self.repeat)
+			self.record("DiskCache.get hit", size, seconds,
+				size / 1048576.0, "MB/s")
+		finally:
+			shutil.rmtree(directory)
+
+	def render(self, count):
+		# Needs a display; importing gophersnake builds its main window.
+		try:
+			import gophersnake
+		except Exception as e:
+			print("%-24s %12d skipped: %s" % ("show_entries", count, e))
+			return
+		entries = gopherlib.parse_bytes(make_menu(count))
+		def run():
+			gophersnake.show_entries(entries)
+			gophersnake.top.update()
+			while gophersnake.render_job != None:
+				gophersnake.top.update()
+		seconds = best_of(run, self.repeat)
+		self.record("show_entries", count, seconds, count, "rows/s")
+
+def main(argv):
+	parser = argparse.ArgumentParser(
+		description="Benchmark the Gophersnake protocol core.")
+	parser.add_argument("--full", action="store_true",
+		help="include 1M-entry menus and a 1 GB body (slow)")
+	parser.add_argument("--repeat", type=int, default=3,
+		help="runs per benchmark, best one counts (default: 3)")
+	parser.add_argument("--json", metavar="FILE",
+		help="also write the results to FILE as JSON")
+	parser.add_argument("--no-gui", action="store_true",
+		help="skip the show_entries benchmark")
+	args = parser.parse_args(argv[1:])
+
+	menu_sizes = [10, 1000, 100000]
+	body_sizes = [1024, 1024 * 1024, 50 * 1024 * 1024]
+	if args.full:
+		menu_sizes.append(1000000)
+		body_sizes.append(1024 * 1024 * 1024)
+
+	server = start_server()
+	suite = Suite(server.server_address[1], args.repeat)
+	for i in body_sizes:
+		suite.fetch(i)
+	for i in menu_sizes:
+		suite.fetch_menu(i)
+	for i in menu_sizes:
+		suite.parse(i)
+	for i in menu_sizes:
+		suite.snapshots(i)
+	for i in menu_sizes:
+		suite.urls(i)
+	for i in menu_sizes:
+		suite.cache_hits(i)
+	for i in body_sizes[:3]:
+		suite.disk_cache_hits(i)
+	if not args.no_gui:
+		for i in menu_sizes:
+			suite.render(i)
+	server.shutdown()
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"python": platform.python_version(),
+				"platform": platform.platform(),
+				"time": time.time(),
+				"results": suite.results}, f, indent=1)
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -1,15 +1,25 @@
 #!/usr/bin/python3
 
-from __future__ import print_function
-
 import sys
 
-if len(sys.argv) > 1:
-	entries = []
-	with open(sys.argv[1], "r") as f:
-		for i in f:
-			entries.append(
-				(i[0],) + tuple(i[1:].rstrip().split("\t")))
+from gopherlib import parse_file, write_to_file
+from gopherlib import Snapshot, is_snapshot, write_snapshot
+
+def read_menu(filename):
+	if is_snapshot(filename):
+		with Snapshot(filename) as snapshot:
+			return list(snapshot)
+	else:
+		return list(parse_file(filename))
+
+if len(sys.argv) == 2:
+	entries = read_menu(sys.argv[1])
 	print(str(entries).replace("), ", "),\n\t"))
+elif len(sys.argv) == 3:
+	# Snapshots become text menus and anything else becomes a snapshot.
+	if is_snapshot(sys.argv[1]):
+		write_to_file(sys.argv[2], read_menu(sys.argv[1]))
+	else:
+		write_snapshot(sys.argv[2], read_menu(sys.argv[1]))
 else:
-	print("Usage:\n\tdir2python <filename>")
+	print("Usage:\n\tdir2python <filename>\n\tdir2python <filename> <output>")
@@ -0,0 +1,285 @@
+# coding=utf-8
+#
+# Gophersnake: stand-alone Gopher client for modern desktops
+# Copyright 2016-2018 Felix Pleșoianu <https://felix.plesoianu.ro/>
+#
+# Offered under the MIT License; see gophersnake.py or LICENSE for full text.
+#
+# Full-text index of visited menus and documents, with ranked search.
+
+import math
+import os
+import pickle
+import re
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from heapq import nlargest
+
+from gopherlib import Directory, entry2url, url2entry
+
+# At most this many documents are scored for any one term; the ones
+# indexed last, that is the pages visited most recently.
+scan_limit = 20000
+
+word_pattern = re.compile(r"\b\w{1,32}\b", re.UNICODE)
+
+def tokenize(text):
+	return word_pattern.findall(text.lower())
+
+def decode_postings(data):
+	# Indexes saved by older versions kept postings as (doc id delta,
+	# term count) pairs of varints.
+	doc = 0
+	n = 0
+	shift = 0
+	values = []
+	for byte in bytearray(data):
+		n |= (byte & 0x7f) << shift
+		if byte & 0x80:
+			shift += 7
+		else:
+			values.append(n)
+			n = 0
+			shift = 0
+	for i in range(0, len(values) - 1, 2):
+		doc += values[i]
+		yield doc, values[i + 1]
+
+class Index(object):
+	"""Inverted index over menu entries and text documents.
+
+	Every indexed item is a document, kept as a menu entry in a
+	Directory so search results can be shown as a menu. Each term has
+	two arrays, of the documents it appears in (in ascending order) and
+	of how often it appears in each, so a term's document frequency is
+	just their length.
+	Re-indexing a URL with new content hides its old document instead
+	of rewriting the postings; compact() drops hidden documents for
+	good, and save() calls it once they make up half the index.
+	"""
+	def __init__(self):
+		self.docs = Directory()
+		self.urls = {}
+		self.lengths = array("L")
+		self.digests = array("L")
+		self.deleted = set()
+		self.postings = {}
+		self.total_length = 0
+		self.dirty = False
+		self.lock = threading.RLock()
+
+	def add(self, entry, words):
+		"""Index entry under words; returns its document id.
+
+		Content that is already indexed under the same URL is left as
+		it is, so pages fetched again and again don't pile up.
+		"""
+		entry = (entry[0], entry[1], entry[2], entry[3], entry[4])
+		digest = zlib.crc32("\t".join(entry + ("",) + tuple(words))
+			.encode("utf-8", "replace"))
+		counts = {}
+		for i in words:
+			counts[i] = counts.get(i, 0) + 1
+		url = entry2url(entry)
+		with self.lock:
+			if url in self.urls:
+				old = self.urls[url]
+				if self.digests[old] == digest:
+					return old
+				self.deleted.add(old)
+			doc = len(self.docs)
+			self.docs.append(entry)
+			self.digests.append(digest)
+			self.urls[url] = doc
+			length = sum(counts.values())
+			self.lengths.append(length)
+			self.total_length += length
+			for term, count in counts.items():
+				hits = self.postings.get(term)
+				if hits == None:
+					hits = self.postings[term] = (array("I"), array("I"))
+				hits[0].append(doc)
+				hits[1].append(count)
+			self.dirty = True
+		return doc
+
+	def add_menu(self, url, entries):
+		# Each link is a document of its own, found by label and
+		# selector; the menu itself is found by its info lines.
+		info = []
+		for e in entries:
+			if len(e) < 5:
+				continue
+			elif e[0] == "i":
+				info.append(e[1])
+			elif e[0] != "3" and entry2url(e) not in self.urls:
+				self.add(e, tokenize(e[1] + " " + e[2]))
+		if len(info) > 0:
+			menu = self.find(url)
+			if menu == None:
+				try:
+					_, _, selector, host, port = url2entry(url)
+				except ValueError:
+					return
+				menu = ("1", url, selector, host, port)
+			self.add(menu, tokenize(menu[1] + " " + " ".join(info)))
+
+	def add_text(self, entry, fn, limit=16 * 1024 * 1024):
+		words = tokenize(entry[1] + " " + entry[2])
+		with open(fn, "rb") as f:
+			carry = ""
+			while f.tell() < limit:
+				chunk = f.read(65536)
+				if not chunk:
+					break
+				# Words cut at the chunk boundary wait for the rest.
+				text = carry + chunk.decode("utf-8", "replace")
+				cut = max(text.rfind(" "), text.rfind("\n"))
+				if cut < 0:
+					carry = text[-64:]
+					continue
+				words.extend(tokenize(text[:cut]))
+				carry = text[cut:]
+			words.extend(tokenize(carry))
+		self.add(entry, words)
+
+	def find(self, url):
+		with self.lock:
+			doc = self.urls.get(url)
+			if doc == None:
+				return None
+			return self.docs[doc]
+
+	def search(self, query, limit=100):
+		"""Return up to limit entries best matching query, by BM25.
+
+		Terms are scored rarest first. Once there are more than limit
+		candidates, a term found in many more documents than that only
+		adds to the candidates' scores, looked up one at a time, instead
+		of scoring every document it appears in. Other than that, only
+		the last scan_limit documents of each term are scored.
+		"""
+		k1 = 1.2
+		b = 0.75
+		scores = {}
+		with self.lock:
+			count = len(self.docs) - len(self.deleted)
+			if count <= 0:
+				return []
+			average = self.total_length / len(self.docs) or 1
+			# The usual BM25 sum, with the constant parts taken out of
+			# the loops below.
+			c1 = k1 * (1 - b)
+			c2 = k1 * b / average
+			lengths = self.lengths
+			terms = [self.postings[i] for i in set(tokenize(query))
+				if i in self.postings]
+			terms.sort(key=lambda hits: len(hits[0]))
+			for docs, counts in terms:
+				found = len(docs)
+				idf = math.log(1 + (count - found + 0.5) / (found + 0.5))
+				weight = idf * (k1 + 1)
+				if len(scores) >= limit and len(scores) * 16 < found:
+					for doc in list(scores):
+						i = bisect_left(docs, doc)
+						if i < found and docs[i] == doc:
+							tf = counts[i]
+							scores[doc] += weight * tf / (
+								tf + c1 + c2 * lengths[doc])
+				else:
+					get = scores.get
+					start = max(found - scan_limit, 0)
+					for doc, tf in zip(docs[start:], counts[start:]):
+						scores[doc] = get(doc, 0) + weight * tf / (
+							tf + c1 + c2 * lengths[doc])
+			# Cheaper than checking every posting.
+			for doc in self.deleted:
+				scores.pop(doc, None)
+			best = nlargest(limit, scores, key=scores.get)
+			return [self.docs[i] for i in best]
+
+	def compact(self):
+		"""Drop hidden documents for good, renumbering the rest."""
+		with self.lock:
+			if len(self.deleted) == 0:
+				return
+			renumbered = {}
+			docs = Directory()
+			lengths = array("L")
+			digests = array("L")
+			for doc, e in enumerate(self.docs):
+				if doc not in self.deleted:
+					renumbered[doc] = len(docs)
+					docs.append(e)
+					lengths.append(self.lengths[doc])
+					digests.append(self.digests[doc])
+			for term, (ids, counts) in list(self.postings.items()):
+				kept = (array("I"), array("I"))
+				for doc, count in zip(ids, counts):
+					if doc in renumbered:
+						kept[0].append(renumbered[doc])
+						kept[1].append(count)
+				if len(kept[0]) > 0:
+					self.postings[term] = kept
+				else:
+					del self.postings[term]
+			self.urls = dict((url, renumbered[doc])
+				for url, doc in self.urls.items())
+			self.docs = docs
+			self.lengths = lengths
+			self.digests = digests
+			self.deleted = set()
+			self.total_length = sum(lengths)
+			self.dirty = True
+
+	def save(self, fn):
+		with self.lock:
+			if len(self.deleted) * 2 > len(self.docs):
+				self.compact()
+			state = {"docs": self.docs, "lengths": self.lengths,
+				"digests": self.digests,
+				"deleted": self.deleted, "postings": self.postings,
+				"total_length": self.total_length}
+			data = zlib.compress(pickle.dumps(state, 2), 1)
+			self.dirty = False
+		directory = os.path.dirname(fn)
+		if directory != "" and not os.path.isdir(directory):
+			os.makedirs(directory)
+		with open(fn + ".tmp", "wb") as f:
+			f.write(data)
+		os.replace(fn + ".tmp", fn)
+
+	@classmethod
+	def load(cls, fn):
+		index = cls()
+		with open(fn, "rb") as f:
+			state = pickle.loads(zlib.decompress(f.read()))
+		index.docs = state["docs"]
+		index.lengths = state["lengths"]
+		# Older indexes have no digests; anything fetched again gets
+		# indexed once more, and has one from then on.
+		index.digests = state.get("digests",
+			array("L", [0] * len(index.docs)))
+		index.deleted = state["deleted"]
+		index.postings = state["postings"]
+		for term, hits in index.postings.items():
+			if isinstance(hits, bytearray):
+				pairs = list(decode_postings(hits))
+				index.postings[term] = (array("I", [i[0] for i in pairs]),
+					array("I", [i[1] for i in pairs]))
+		index.total_length = state["total_length"]
+		for doc, e in enumerate(index.docs):
+			if doc not in index.deleted:
+				index.urls[entry2url(e)] = doc
+		return index
+
+def data_dir():
+	base = os.environ.get("XDG_DATA_HOME")
+	if not base:
+		base = os.path.join(os.path.expanduser("~"), ".local", "share")
+	return os.path.join(base, "gophersnake")
+
+def index_file():
+	return os.path.join(data_dir(), "index")
@@ -0,0 +1,1376 @@
+# coding=utf-8
+#
+# Gophersnake: stand-alone Gopher client for modern desktops
+# Copyright 2016-2018 Felix Pleșoianu <https://felix.plesoianu.ro/>
+# IPv6 support by madscientistninja <https://github.com/madscientistninja>
+#
+# Offered under the MIT License; see gophersnake.py or LICENSE for full text.
+#
+# Protocol core: fetching, menu parsing, URL formatting and caching.
+# Nothing in here touches Tk, so it can be imported by batch tools and
+# benchmarks running on headless machines.
+
+import errno
+import hashlib
+import json
+import mmap
+import os
+import queue
+import re
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+
+entry_types = {"0": "[TXT]", "1": "[DIR]", "2": "[CSO]", "3": "[ERR]",
+	"4": "[HEX]", "5": "[ARC]", "6": "[ENC]", "7": "[QRY]",
+	"8": "[TLN]", "9": "[BIN]", "g": "[GIF]", "h": "[HTM]",
+	"i": "", "I": "[IMG]", "s": "[SND]", "M": "MIME?", "d": "[PDF]"}
+
+class LRUCache(object):
+	"""Least recently used cache, bounded by entry count and total size.
+
+	Sizes are given to put() or estimated by sizeof(). Entries put with
+	a ttl count as missing once that many seconds have passed. Hits,
+	misses and evictions are counted for tuning the limits.
+	"""
+	def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.items = OrderedDict()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.RLock()
+
+	def get(self, key, default=None):
+		with self.lock:
+			if key in self:
+				self.items.move_to_end(key)
+				self.hits += 1
+				return self.items[key][0]
+			self.misses += 1
+			return default
+
+	def put(self, key, value, size=None, ttl=None):
+		if size == None:
+			size = sizeof(value)
+		if ttl != None:
+			expires = time.time() + ttl
+		else:
+			expires = None
+		with self.lock:
+			self.discard(key)
+			if size > self.max_bytes:
+				return
+			self.items[key] = (value, size, expires)
+			self.nbytes += size
+			while (len(self.items) > self.max_entries
+					or self.nbytes > self.max_bytes):
+				_, (_, old_size, _) = self.items.popitem(last=False)
+				self.nbytes -= old_size
+				self.evictions += 1
+
+	def discard(self, key):
+		with self.lock:
+			if key in self.items:
+				self.nbytes -= self.items.pop(key)[1]
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+			self.nbytes = 0
+
+	def __contains__(self, key):
+		with self.lock:
+			item = self.items.get(key)
+			if item == None:
+				return False
+			elif item[2] != None and item[2] <= time.time():
+				self.discard(key)
+				return False
+			return True
+
+	def __len__(self):
+		return len(self.items)
+
+	def stats(self):
+		return {"entries": len(self.items), "bytes": self.nbytes,
+			"hits": self.hits, "misses": self.misses,
+			"evictions": self.evictions}
+
+def sizeof(value):
+	# Rough memory footprint of a cached body or list of menu entries.
+	if isinstance(value, (bytes, bytearray)):
+		return len(value)
+	elif isinstance(value, Directory):
+		return value.nbytes()
+	total = sys.getsizeof(value)
+	for e in value:
+		total += sys.getsizeof(e)
+		for field in e:
+			total += sys.getsizeof(field)
+	return total
+
+cache = LRUCache()
+
+class DiskCache(object):
+	"""Raw responses kept on disk across sessions, keyed by URL.
+
+	The file modification time records when each response was fetched.
+	Entries of mmap_threshold bytes or more come back memory-mapped, so
+	callers should treat results as bytes-like rather than as bytes.
+	"""
+	def __init__(self, directory, max_age=7 * 24 * 3600,
+			mmap_threshold=1024 * 1024):
+		self.directory = directory
+		self.max_age = max_age
+		self.mmap_threshold = mmap_threshold
+
+	def path(self, url):
+		name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+		return os.path.join(self.directory, name[:2], name)
+
+	def fetched(self, url):
+		try:
+			return os.path.getmtime(self.path(url))
+		except OSError:
+			return None
+
+	def fresh(self, url, max_age=None):
+		# The file name of a cached entry younger than max_age, if any.
+		if max_age == None:
+			max_age = self.max_age
+		fetched = self.fetched(url)
+		if fetched == None or time.time() - fetched > max_age:
+			return None
+		return self.path(url)
+
+	def get(self, url, max_age=None):
+		fn = self.fresh(url, max_age)
+		if fn == None:
+			return None
+		try:
+			with open(fn, "rb") as f:
+				size = os.fstat(f.fileno()).st_size
+				if size < self.mmap_threshold or size == 0:
+					return f.read()
+				return mmap.mmap(
+					f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return None
+
+	def temp_path(self, url):
+		# Somewhere to download url to before commit() moves it in place.
+		fn = self.path(url)
+		if not os.path.isdir(os.path.dirname(fn)):
+			os.makedirs(os.path.dirname(fn))
+		return "%s.%d.%d" % (
+			fn, os.getpid(), threading.current_thread().ident)
+
+	def commit(self, url, tmp):
+		fn = self.path(url)
+		os.replace(tmp, fn)
+		return fn
+
+	def put(self, url, data):
+		tmp = None
+		try:
+			tmp = self.temp_path(url)
+			with open(tmp, "wb") as f:
+				f.write(data)
+			self.commit(url, tmp)
+		except OSError:
+			# A cache that can't be written to is merely a slow cache.
+			try:
+				if tmp != None:
+					os.remove(tmp)
+			except OSError:
+				pass
+
+	def discard(self, url):
+		try:
+			os.remove(self.path(url))
+		except OSError:
+			pass
+
+	def prune(self):
+		# Drop entries past max_age; call now and then, e.g. on startup.
+		limit = time.time() - self.max_age
+		for root, dirs, files in os.walk(self.directory):
+			for name in files:
+				fn = os.path.join(root, name)
+				try:
+					if os.path.getmtime(fn) < limit:
+						os.remove(fn)
+				except OSError:
+					pass
+
+def cache_dir():
+	base = os.environ.get("XDG_CACHE_HOME")
+	if not base:
+		base = os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "gophersnake")
+
+disk_cache = DiskCache(cache_dir())
+
+# Bytes asked of the socket per recv() call; bigger means fewer calls.
+read_size = 65536
+
+def entry2url(e):
+	assert len(e) >= 5
+	#type label selector host port
+	if e[0] == "h" and e[2].startswith("URL:"):
+		return e[2][4:]
+	elif len(e) < 5:
+		return str(e)
+
+	if e[2] == "":
+		return url_prefix(e[3], e[4])
+	else:
+		return "%s/%1s%s" % (url_prefix(e[3], e[4]), e[0], e[2])
+
+def url_prefix(host, port):
+	if port == "70":
+		port = ""
+	else:
+		port = ":" + str(port)
+	if host_is_ipv6(host):
+		return "gopher://[%s]%s" % (host, port)
+	else:
+		return "gopher://%s%s" % (host, port)
+
+# Host name -> whether it's an IPv6 address literal. Only names with a
+# colon in them can be, so the rest never reach inet_pton at all.
+ipv6_hosts = {}
+
+def host_is_ipv6(host):
+	host = str(host)
+	if ":" not in host:
+		return False
+	known = ipv6_hosts.get(host)
+	if known == None:
+		if len(ipv6_hosts) >= 4096:
+			ipv6_hosts.clear()
+		known = ipv6_hosts[host] = is_it_ipv6(host, None, True)
+	return known
+
+def url2entry(url):
+	# The inverse of entry2url for gopher:// addresses.
+	parsed = urlparse(url)
+	if parsed.scheme != "gopher":
+		raise ValueError("Not a gopher address: " + url)
+	if parsed.port == None:
+		port = "70"
+	else:
+		port = str(parsed.port)
+	# entry2url doesn't escape "?" or "#", so the selector is everything
+	# after the host, not just what urlparse considers the path.
+	rest = url.split("://", 1)[1]
+	slash = rest.find("/")
+	if slash < 0 or slash == len(rest) - 1:
+		return ("1", "", "", parsed.hostname, port)
+	selector = rest[slash + 1:]
+	if selector[0] not in entry_types:
+		raise ValueError("Unknown selector type.")
+	return (selector[0], "", selector[1:], parsed.hostname, port)
+
+def str2entry(line):
+	line = line.strip()
+	if len(line) == 0:
+		return None
+	elif len(line) == 1 and line[0] == ".":
+		return None
+	else:
+		return (line[0],) + tuple(line[1:].rstrip().split("\t"))
+
+class MenuParser(object):
+	"""Turns menu data into entries as soon as each line is complete.
+
+	Feed it chunks in arrival order; lines may span chunk boundaries.
+	Parsing stops at the "." terminator line, after which done is set.
+	"""
+	def __init__(self):
+		self.partial = []
+		self.done = False
+
+	def feed(self, chunk):
+		entries = []
+		start = 0
+		while not self.done:
+			end = chunk.find(b"\n", start)
+			if end < 0:
+				if start < len(chunk):
+					self.partial.append(chunk[start:])
+				break
+			self.partial.append(chunk[start:end])
+			self.add_line(b"".join(self.partial), entries)
+			self.partial = []
+			start = end + 1
+		return entries
+
+	def close(self):
+		entries = []
+		if not self.done and len(self.partial) > 0:
+			self.add_line(b"".join(self.partial), entries)
+		self.partial = []
+		self.done = True
+		return entries
+
+	def add_line(self, line, entries):
+		line = line.decode("latin_1")
+		if line.strip() == ".":
+			self.done = True
+			return
+		e = str2entry(line)
+		if e != None:
+			entries.append(e)
+
+class Directory(object):
+	"""Compact, list-like storage for the entries of a menu.
+
+	Entries go in and come out as tuples, but are kept as tab-separated
+	lines in a few large shared strings, found through an array of line
+	offsets. That costs a few bytes per entry on top of the text itself,
+	where a tuple of separate strings costs a few hundred. Appending is
+	cheap; lines are joined into a new block on the first read after.
+	"""
+	def __init__(self, entries=()):
+		self.blocks = []
+		self.block_first = array("L")
+		self.starts = array("L")
+		self.pending = []
+		self.pending_len = 0
+		self.extend(entries)
+
+	def append(self, e):
+		line = "\t".join(e) + "\n"
+		self.starts.append(self.pending_len)
+		self.pending.append(line)
+		self.pending_len += len(line)
+
+	def extend(self, entries):
+		for e in entries:
+			self.append(e)
+
+	def flush(self):
+		if len(self.pending) > 0:
+			self.block_first.append(len(self.starts) - len(self.pending))
+			self.blocks.append("".join(self.pending))
+			self.pending = []
+			self.pending_len = 0
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		if i < 0:
+			i += len(self.starts)
+		if i < 0 or i >= len(self.starts):
+			raise IndexError("menu index out of range")
+		self.flush()
+		block = self.blocks[bisect_right(self.block_first, i) - 1]
+		start = self.starts[i]
+		return tuple(block[start:block.index("\n", start)].split("\t"))
+
+	def __iter__(self):
+		# Walks the blocks in order rather than bisecting for each entry.
+		self.flush()
+		starts = self.starts
+		for b in range(len(self.blocks)):
+			block = self.blocks[b]
+			if b + 1 < len(self.blocks):
+				last = self.block_first[b + 1]
+			else:
+				last = len(starts)
+			for i in range(self.block_first[b], last):
+				start = starts[i]
+				yield tuple(
+					block[start:block.index("\n", start)].split("\t"))
+
+	def nbytes(self):
+		self.flush()
+		total = sys.getsizeof(self) + sys.getsizeof(self.blocks)
+		for i in self.blocks:
+			total += sys.getsizeof(i)
+		total += self.starts.itemsize * len(self.starts)
+		total += self.block_first.itemsize * len(self.block_first)
+		return total
+
+def iter_entries(chunks):
+	parser = MenuParser()
+	for i in chunks:
+		for e in parser.feed(i):
+			yield e
+		if parser.done:
+			break
+	for e in parser.close():
+		yield e
+
+def parse_bytes(data):
+	return Directory(iter_entries([data]))
+
+def parse_file(filename):
+	with open(filename, "r") as f:
+		for i in f:
+			yield (i[0],) + tuple(i[1:].rstrip().split("\t"))
+
+def write_to_file(filename, entries):
+	with open(filename, "w", newline="\r\n") as f:
+		for i in entries:
+			print("%s%s\t%s\t%s\t%s" % i, file=f)
+
+# Binary menu snapshots: a header (magic, entry count, index position),
+# then each entry as a field count byte, the byte length of each field
+# and the UTF-8 fields themselves, then an index of where entries start.
+# Fields are also tab-separated, as tabs can't occur in them anyway, so
+# an entry can be split with one call instead of a loop over lengths.
+snapshot_magic = b"GSNAP\x00\x01\x00"
+snapshot_header = struct.Struct("<8sIQ")
+snapshot_offset = struct.Struct("<I")
+snapshot_lengths = {}
+
+def _lengths_struct(count):
+	# Field count byte plus one 16-bit length per field.
+	if count not in snapshot_lengths:
+		snapshot_lengths[count] = struct.Struct("<B%dH" % count)
+	return snapshot_lengths[count]
+
+def write_snapshot(filename, entries):
+	"""Save entries as a binary snapshot, in one write."""
+	parts = []
+	offsets = array("I")
+	pos = snapshot_header.size
+	for e in entries:
+		offsets.append(pos)
+		line = "\t".join(e)
+		data = line.encode("utf-8")
+		if len(data) == len(line):
+			lengths = [len(i) for i in e]
+		else:
+			lengths = [len(i.encode("utf-8")) for i in e]
+		if len(data) > 0xffff and max(lengths) > 0xffff:
+			raise ValueError("Menu field too long for a snapshot.")
+		parts.append(_lengths_struct(len(e)).pack(len(e), *lengths))
+		parts.append(data)
+		pos += 1 + 2 * len(e) + len(data)
+	if pos > 0xffffffff:
+		raise ValueError("Menu too big for a snapshot.")
+	if sys.byteorder != "little":
+		offsets.byteswap()
+	parts.insert(0, snapshot_header.pack(snapshot_magic, len(offsets), pos))
+	parts.append(offsets.tobytes())
+	with open(filename, "wb") as f:
+		f.write(b"".join(parts))
+
+def is_snapshot(filename):
+	with open(filename, "rb") as f:
+		return f.read(len(snapshot_magic)) == snapshot_magic
+
+class Snapshot(object):
+	"""Read-only, list-like view of a menu snapshot file.
+
+	The file is memory-mapped and entries are only decoded when asked
+	for, so opening even a huge menu takes no time. Call close(), or use
+	it in a with statement, to let go of the file.
+	"""
+	def __init__(self, filename):
+		with open(filename, "rb") as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			magic, self.count, self.index = snapshot_header.unpack_from(
+				self.data, 0)
+			if magic != snapshot_magic:
+				raise ValueError("Not a menu snapshot.")
+			end = self.index + self.count * snapshot_offset.size
+			if end > len(self.data):
+				raise ValueError("Menu snapshot is truncated.")
+		except Exception:
+			self.data.close()
+			raise
+
+	def close(self):
+		self.data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(self.count))]
+		if i < 0:
+			i += self.count
+		if i < 0 or i >= self.count:
+			raise IndexError("menu index out of range")
+		pos = snapshot_offset.unpack_from(
+			self.data, self.index + i * snapshot_offset.size)[0]
+		return self.decode(pos)
+
+	def __iter__(self):
+		# Each entry ends where the next one starts, and the last one
+		# where the index does.
+		offsets = array("I")
+		index = self.data[self.index:self.index
+			+ self.count * snapshot_offset.size]
+		offsets.frombytes(index)
+		if sys.byteorder != "little":
+			offsets.byteswap()
+		offsets.append(self.index)
+		data = self.data
+		for i in range(self.count):
+			start = offsets[i]
+			count = bytearray(data[start:start + 1])[0]
+			if count == 0:
+				yield ()
+			else:
+				yield tuple(data[start + 1 + 2 * count:offsets[i + 1]]
+					.decode("utf-8").split("\t"))
+
+	def decode(self, pos):
+		data = self.data
+		count = bytearray(data[pos:pos + 1])[0]
+		if count == 0:
+			return ()
+		start = pos + 1 + 2 * count
+		end = start + sum(_lengths_struct(count).unpack_from(data, pos)[1:])
+		return tuple(data[start:end + count - 1].decode("utf-8").split("\t"))
+
+	def close(self):
+		self.data.close()
+
+def is_it_ipv6(host, port, nodnslookup):
+	if nodnslookup:
+		try:
+			socket.inet_pton(socket.AF_INET6, str(host))
+		except socket.error:
+			return False
+		return True
+	else:
+		try:
+			socket.inet_pton(
+				socket.AF_INET6,
+				socket.getaddrinfo(host, port)[0][4][0])
+		except socket.error:
+			return False
+		return True
+
+class Resolver(object):
+	"""Caches getaddrinfo() results for ttl seconds, up to max_hosts."""
+	def __init__(self, ttl=300, max_hosts=256):
+		self.ttl = ttl
+		self.max_hosts = max_hosts
+		self.entries = {}
+		self.lock = threading.Lock()
+
+	def resolve(self, host, port):
+		key = (host, int(port))
+		now = time.time()
+		with self.lock:
+			hit = self.entries.get(key)
+			if hit != None and hit[0] > now:
+				return hit[1]
+		infos = interleave_families(socket.getaddrinfo(
+			host, int(port), 0, socket.SOCK_STREAM))
+		with self.lock:
+			if key not in self.entries:
+				while len(self.entries) >= self.max_hosts:
+					self.evict(now)
+			self.entries[key] = (now + self.ttl, infos)
+		return infos
+
+	def evict(self, now):
+		# Expired entries go first; failing that, the one expiring soonest.
+		expired = [k for k, v in self.entries.items() if v[0] <= now]
+		if len(expired) == 0:
+			expired = [min(self.entries,
+				key=lambda k: self.entries[k][0])]
+		for k in expired:
+			del self.entries[k]
+
+	def forget(self, host, port):
+		with self.lock:
+			self.entries.pop((host, int(port)), None)
+
+def interleave_families(infos):
+	# Alternate address families, as in RFC 8305, so a dead IPv6 route
+	# only ever costs one connection attempt before IPv4 gets a turn.
+	first = [i for i in infos if i[0] == infos[0][0]]
+	other = [i for i in infos if i[0] != infos[0][0]]
+	mixed = []
+	for i in range(max(len(first), len(other))):
+		mixed.extend(first[i:i + 1])
+		mixed.extend(other[i:i + 1])
+	return mixed
+
+resolver = Resolver()
+
+# Seconds to wait on one address before also trying the next one.
+connect_delay = 0.25
+
+class FetchError(IOError):
+	pass
+
+class ConnectError(FetchError):
+	pass
+
+class ConnectTimeout(ConnectError):
+	pass
+
+class FirstByteTimeout(FetchError):
+	pass
+
+class IdleTimeout(FetchError):
+	pass
+
+class StalledTransfer(FetchError):
+	pass
+
+class RequestTimeout(FetchError):
+	pass
+
+class ConnectionLost(FetchError):
+	pass
+
+class Timeouts(object):
+	"""Limits on how long a request may take, in seconds.
+
+	connect covers all connection attempts, first_byte the wait for the
+	start of the response and idle any later wait for more data. When
+	min_rate (bytes per second) is set, a transfer averaging less than
+	that over stall_window seconds of waiting is given up. total bounds
+	the whole request. Any of them can be None for no limit.
+	"""
+	def __init__(self, connect=20, first_byte=30, idle=60,
+			min_rate=None, stall_window=30, total=None):
+		self.connect = connect
+		self.first_byte = first_byte
+		self.idle = idle
+		self.min_rate = min_rate
+		self.stall_window = stall_window
+		self.total = total
+
+	def until(self, limit, deadline):
+		# The smaller of a phase limit and what's left before deadline.
+		if deadline == None:
+			return limit
+		left = deadline - time.time()
+		if left <= 0:
+			raise RequestTimeout("Request took too long")
+		if limit == None:
+			return left
+		return min(limit, left)
+
+timeouts = Timeouts()
+
+class Trace(object):
+	"""Where the time went in one request.
+
+	times maps phase names to seconds: "wait" for a scheduler slot,
+	"dns", "connect", "first_byte" (request sent to first data),
+	"transfer" (first data to last), "parse" and "render". cache says
+	where the content came from: "memory", "disk" or "network".
+	"""
+	def __init__(self, url=None, cache="network"):
+		self.url = url
+		self.cache = cache
+		self.started = time.time()
+		self.times = {}
+		self.bytes = 0
+		self.error = None
+
+	def add(self, phase, seconds):
+		self.times[phase] = self.times.get(phase, 0) + seconds
+
+	def as_dict(self):
+		result = {"url": self.url, "cache": self.cache,
+			"started": self.started, "bytes": self.bytes}
+		result.update(self.times)
+		if self.error != None:
+			result["error"] = self.error
+		return result
+
+def percentile(values, fraction):
+	# Nearest rank; values must be sorted.
+	if len(values) == 0:
+		return None
+	return values[min(int(fraction * len(values)), len(values) - 1)]
+
+class Metrics(object):
+	"""Collects finished Traces.
+
+	The last keep of them stay in memory for summary(). Each one is
+	also passed to every function in hooks, from whatever thread
+	finished the request, and written as a JSON line to the log file
+	if one is open.
+	"""
+	def __init__(self, keep=1000):
+		self.traces = deque(maxlen=keep)
+		self.hooks = []
+		self.log = None
+		self.lock = threading.Lock()
+
+	def open_log(self, fn):
+		self.close_log()
+		self.log = open(fn, "a")
+
+	def close_log(self):
+		with self.lock:
+			if self.log != None:
+				self.log.close()
+				self.log = None
+
+	def failed(self, trace, error):
+		# A cancelled request was stopped on purpose, by Escape or by
+		# leaving the page, so it's neither a failure nor worth timing.
+		if isinstance(error, Cancelled):
+			return
+		trace.error = str(error) or error.__class__.__name__
+		self.record(trace)
+
+	def record(self, trace):
+		with self.lock:
+			self.traces.append(trace)
+			if self.log != None:
+				self.log.write(json.dumps(trace.as_dict()) + "\n")
+				self.log.flush()
+			hooks = list(self.hooks)
+		for i in hooks:
+			i(trace)
+
+	def summary(self):
+		"""Percentiles per phase, plus cache and error counts."""
+		with self.lock:
+			traces = list(self.traces)
+		phases = {}
+		for t in traces:
+			for phase, seconds in t.times.items():
+				phases.setdefault(phase, []).append(seconds)
+		for phase, values in phases.items():
+			values.sort()
+			phases[phase] = {"count": len(values),
+				"p50": percentile(values, 0.5),
+				"p90": percentile(values, 0.9),
+				"p99": percentile(values, 0.99)}
+		hits = len([t for t in traces if t.cache != "network"])
+		return {"requests": len(traces), "phases": phases,
+			"cache_hits": hits,
+			"hit_ratio": hits / len(traces) if traces else None,
+			"bytes": sum(t.bytes for t in traces),
+			"errors": len([t for t in traces if t.error != None])}
+
+metrics = Metrics()
+
+_in_progress = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+# Applied to every socket connect() opens. No delay, since the whole
+# request is one short line sent right away.
+socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+
+def connect(host, port, timeout=None, trace=None):
+	"""Connect to the first address of host that answers.
+
+	Addresses come from the resolver cache. A new attempt starts every
+	connect_delay seconds, or as soon as the previous one fails, while
+	the earlier ones are kept waiting ("happy eyeballs"). Raises
+	ConnectTimeout if nothing answers within timeout seconds, or
+	ConnectError if every address refuses. The time spent looking up
+	and connecting is added to trace, if given.
+	"""
+	started = time.time()
+	if timeout != None:
+		deadline = started + timeout
+	try:
+		infos = resolver.resolve(host, port)
+	except socket.error as e:
+		raise ConnectError("Can't find %s: %s" % (host, e.strerror or e))
+	except UnicodeError:
+		# Host names that can't be IDNA encoded, like "a..b".
+		raise ConnectError("Bad host name: %s" % host)
+	finally:
+		if trace != None:
+			trace.add("dns", time.time() - started)
+			started = time.time()
+	pending = []
+	error = None
+	next_info = 0
+	try:
+		while len(pending) > 0 or next_info < len(infos):
+			if next_info < len(infos):
+				family, socktype, proto, _, addr = infos[next_info]
+				next_info += 1
+				sock = None
+				try:
+					# Fails outright for families the system lacks,
+					# such as IPv6; the other addresses are still tried.
+					sock = socket.socket(family, socktype, proto)
+					for option in socket_options:
+						sock.setsockopt(*option)
+					sock.setblocking(False)
+					err = sock.connect_ex(addr)
+				except socket.error as e:
+					if sock != None:
+						sock.close()
+					error = e
+					continue
+				if err == 0 or err in _in_progress:
+					pending.append(sock)
+				else:
+					sock.close()
+					error = socket.error(err, os.strerror(err))
+					continue
+			if next_info < len(infos):
+				wait = connect_delay
+			else:
+				wait = None
+			if timeout != None:
+				left = deadline - time.time()
+				if left <= 0:
+					resolver.forget(host, port)
+					raise ConnectTimeout(
+						"Timed out connecting to %s" % host)
+				if wait == None or left < wait:
+					wait = left
+			_, ready, failed = select.select([], pending, pending, wait)
+			for sock in set(ready + failed):
+				pending.remove(sock)
+				err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if err == 0 and sock not in failed:
+					sock.setblocking(True)
+					if trace != None:
+						trace.add("connect", time.time() - started)
+					return sock
+				sock.close()
+				error = socket.error(err, os.strerror(err))
+		# The addresses may be out of date; look them up again next time.
+		resolver.forget(host, port)
+		if error == None:
+			raise ConnectError("No addresses found for " + host)
+		raise ConnectError("Can't connect to %s: %s" % (
+			host, error.strerror or error))
+	finally:
+		for sock in pending:
+			sock.close()
+
+def fetch_data(selector, host, port, chunk_size=None, limits=None,
+		trace=None):
+	"""Yield the response to selector from host, a chunk at a time.
+
+	Timings and byte counts go into trace. Without one, the request
+	gets a Trace of its own, handed to metrics once it's over.
+	"""
+	if trace == None:
+		return _traced(fetch_data, selector, host, port, chunk_size, limits)
+	return _fetch_data(selector, host, port, chunk_size, limits, trace)
+
+def _traced(fetch, selector, host, port, *args):
+	# The URL says "binary" since nothing here knows the real type.
+	trace = Trace(entry2url(("9", "", selector, host, str(port))))
+	cancelled = False
+	try:
+		for i in fetch(selector, host, port, *(args + (trace,))):
+			yield i
+	except Cancelled:
+		cancelled = True
+		raise
+	except Exception as e:
+		trace.error = str(e) or e.__class__.__name__
+		raise
+	finally:
+		if not cancelled:
+			metrics.record(trace)
+
+def _fetch_data(selector, host, port, chunk_size, limits, trace):
+	if chunk_size == None:
+		chunk_size = read_size
+	if limits == None:
+		limits = timeouts
+	if limits.total != None:
+		deadline = time.time() + limits.total
+	else:
+		deadline = None
+	sock = connect(host, port, limits.until(limits.connect, deadline), trace)
+	try:
+		try:
+			sock.settimeout(limits.until(limits.first_byte, deadline))
+			started = time.time()
+			sock.sendall((selector + "\r\n").encode())
+			data = sock.recv(chunk_size)
+		except socket.timeout:
+			limits.until(None, deadline)
+			raise FirstByteTimeout("%s sent no response" % host)
+		except socket.error as e:
+			raise connection_lost(host, e) from e
+		trace.add("first_byte", time.time() - started)
+		trace.bytes += len(data)
+		# Only time spent waiting on the socket counts towards the rate,
+		# not time the consumer spends with each chunk.
+		window_bytes = 0
+		window_time = 0
+		while data:
+			yield data
+			sock.settimeout(limits.until(limits.idle, deadline))
+			started = time.time()
+			try:
+				data = sock.recv(chunk_size)
+			except socket.timeout:
+				limits.until(None, deadline)
+				raise IdleTimeout("%s stopped sending data" % host)
+			except socket.error as e:
+				raise connection_lost(host, e) from e
+			window_bytes += len(data)
+			window_time += time.time() - started
+			trace.add("transfer", time.time() - started)
+			trace.bytes += len(data)
+			if limits.min_rate and window_time >= limits.stall_window:
+				if window_bytes < limits.min_rate * window_time:
+					raise StalledTransfer(
+						"Transfer from %s stalled" % host)
+				window_bytes = 0
+				window_time = 0
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except socket.error as e:
+			# Some systems say so when the server closed first.
+			if e.errno != errno.ENOTCONN:
+				raise connection_lost(host, e) from e
+	finally:
+		# Also runs if the consumer stops early, e.g. at a "." line.
+		sock.close()
+
+def connection_lost(host, error):
+	return ConnectionLost("Connection to %s lost: %s" % (
+		host, error.strerror or error))
+
+class Transfer(object):
+	"""Counts the bytes of one download, for progress displays.
+
+	expected is the size in bytes if known; Gopher doesn't say, but
+	menu labels often hint at it (see size_hint).
+	"""
+	def __init__(self, expected=None):
+		self.expected = expected
+		self.received = 0
+		self.started = time.time()
+
+	def elapsed(self):
+		return time.time() - self.started
+
+	def rate(self):
+		elapsed = self.elapsed()
+		if elapsed <= 0:
+			return 0
+		return self.received / elapsed
+
+	def eta(self):
+		rate = self.rate()
+		if not self.expected or rate <= 0:
+			return None
+		return max(self.expected - self.received, 0) / rate
+
+	def describe(self):
+		text = format_size(self.received)
+		if self.expected:
+			text += " of ~" + format_size(self.expected)
+		text += ", %s/s" % format_size(self.rate())
+		eta = self.eta()
+		if eta != None:
+			text += ", %d s left" % eta
+		return text
+
+def format_size(size):
+	for unit in ("bytes", "KB", "MB"):
+		if size < 1024:
+			return "%.0f %s" % (size, unit)
+		size /= 1024.0
+	return "%.1f GB" % size
+
+size_pattern = re.compile(
+	r"(\d+(?:\.\d+)?)\s*(bytes|[kmg])(?:i?b)?\b", re.IGNORECASE)
+
+def size_hint(label):
+	# Sizes like "(12K)", "1.5 MB" or "3400 bytes" in a menu label.
+	match = size_pattern.search(label)
+	if match == None:
+		return None
+	unit = match.group(2).lower()
+	scale = {"bytes": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+	return int(float(match.group(1)) * scale[unit])
+
+def image_size(filename):
+	"""Return (format, width, height) from an image file's header.
+
+	Knows GIF, PNG, JPEG and PPM/PGM; for anything else the format is
+	None. Only the start of the file is read, so this is cheap even for
+	images far too big to decode.
+	"""
+	with open(filename, "rb") as f:
+		head = f.read(32)
+		if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+			return ("gif",) + struct.unpack("<HH", head[6:10])
+		elif head[:8] == b"\x89PNG\r\n\x1a\n" and len(head) >= 24:
+			return ("png",) + struct.unpack(">II", head[16:24])
+		elif head[:2] in (b"P5", b"P6"):
+			fields = re.sub(br"#[^\n]*\n", b" ", head + f.read(224)).split()
+			if len(fields) >= 3:
+				return ("ppm", int(fields[1]), int(fields[2]))
+		elif head[:2] == b"\xff\xd8":
+			return _jpeg_size(f)
+	return (None, None, None)
+
+def _jpeg_size(f):
+	# Walk the markers up to the first start-of-frame.
+	f.seek(2)
+	while True:
+		marker = f.read(2)
+		if len(marker) < 2 or marker[:1] != b"\xff":
+			return (None, None, None)
+		kind = bytearray(marker)[1]
+		if kind in (0xd8, 0x01) or 0xd0 <= kind <= 0xd7:
+			continue
+		length = f.read(2)
+		if len(length) < 2:
+			return (None, None, None)
+		length = struct.unpack(">H", length)[0]
+		if 0xc0 <= kind <= 0xcf and kind not in (0xc4, 0xc8, 0xcc):
+			frame = f.read(5)
+			if len(frame) < 5:
+				return (None, None, None)
+			height, width = struct.unpack(">xHH", frame)
+			return ("jpeg", width, height)
+		f.seek(length - 2, 1)
+
+class Scheduler(object):
+	"""The one gate every download goes through.
+
+	At most limit requests run at once, and at most per_host against
+	any one server. Requests over those limits wait their turn, taken
+	round-robin across servers so that one busy host can't hold up the
+	rest. Address lookups are shared through the resolver cache.
+	"""
+	def __init__(self, limit=8, per_host=2):
+		self.limit = limit
+		self.per_host = per_host
+		self.running = 0
+		self.active = {}
+		self.waiting = OrderedDict()
+		self.cond = threading.Condition()
+
+	def acquire(self, host, job=None):
+		host = host.lower()
+		ticket = [False]
+		with self.cond:
+			self.waiting.setdefault(host, deque()).append(ticket)
+			self.dispatch()
+			while not ticket[0]:
+				if job != None and job.cancelled:
+					self.waiting[host].remove(ticket)
+					if len(self.waiting[host]) == 0:
+						del self.waiting[host]
+					raise Cancelled()
+				self.cond.wait(0.25)
+
+	def release(self, host):
+		host = host.lower()
+		with self.cond:
+			self.running -= 1
+			self.active[host] -= 1
+			if self.active[host] == 0:
+				del self.active[host]
+			self.dispatch()
+
+	def dispatch(self):
+		# Called with the lock held; hands free slots to waiting tickets.
+		granted = True
+		while granted and self.running < self.limit:
+			granted = False
+			for host in list(self.waiting):
+				if self.running >= self.limit:
+					break
+				if self.active.get(host, 0) >= self.per_host:
+					continue
+				tickets = self.waiting[host]
+				tickets.popleft()[0] = True
+				self.running += 1
+				self.active[host] = self.active.get(host, 0) + 1
+				if len(tickets) > 0:
+					self.waiting.move_to_end(host)
+				else:
+					del self.waiting[host]
+				granted = True
+		self.cond.notify_all()
+
+	def fetch_data(self, selector, host, port, job=None, chunk_size=None,
+			limits=None, trace=None):
+		"""Like gopherlib.fetch_data, once a slot is free for host.
+
+		If job is given, cancelling it also gives up the wait. Time
+		spent waiting counts as the "wait" phase of trace.
+		"""
+		if trace == None:
+			return _traced(self.fetch_data, selector, host, port,
+				job, chunk_size, limits)
+		return self._fetch_data(
+			selector, host, port, job, chunk_size, limits, trace)
+
+	def _fetch_data(self, selector, host, port, job, chunk_size, limits,
+			trace):
+		started = time.time()
+		self.acquire(host, job)
+		trace.add("wait", time.time() - started)
+		try:
+			for i in fetch_data(
+					selector, host, port, chunk_size, limits, trace):
+				if job != None:
+					job.check()
+				yield i
+		finally:
+			self.release(host)
+
+	def queue_depth(self):
+		with self.cond:
+			return sum(len(i) for i in self.waiting.values())
+
+	def stats(self):
+		with self.cond:
+			return {"running": self.running,
+				"waiting": sum(len(i) for i in self.waiting.values()),
+				"hosts": dict(self.active)}
+
+scheduler = Scheduler()
+
+def download(selector, host, port, fn, transfer=None, report=None,
+		limits=None, job=None, trace=None):
+	"""Stream a response straight into the file fn.
+
+	Writes go through a large buffer. report, if given, is called with
+	the Transfer at most ten times a second. The request waits its turn
+	with the scheduler, like any other.
+	"""
+	if transfer == None:
+		transfer = Transfer()
+	last_report = 0
+	with open(fn, "wb", 1024 * 1024) as f:
+		for i in scheduler.fetch_data(
+				selector, host, port, job, None, limits, trace):
+			f.write(i)
+			transfer.received += len(i)
+			if report != None and time.time() - last_report >= 0.1:
+				last_report = time.time()
+				report(transfer)
+	return transfer
+
+class Cancelled(Exception):
+	pass
+
+class Job(object):
+	"""Work queued on a WorkerPool; fn gets called as fn(job, *args).
+
+	Long-running functions should call job.check() now and then, which
+	raises Cancelled once cancel() was called, and may call report() to
+	send progress values to the owning thread.
+	"""
+	def __init__(self, pool, fn, args, done, failed, progress):
+		self.pool = pool
+		self.fn = fn
+		self.args = args
+		self.done = done
+		self.failed = failed
+		self.progress = progress
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+	def check(self):
+		if self.cancelled:
+			raise Cancelled()
+
+	def report(self, value):
+		self.check()
+		if self.progress != None:
+			self.pool.results.put((self, self.progress, value))
+
+class WorkerPool(object):
+	"""Runs jobs on background threads and queues up their outcomes.
+
+	Callbacks never run on the worker threads. Whoever owns the pool
+	(the Tk loop, say) calls poll() regularly, and the done, failed and
+	progress callbacks of jobs that weren't cancelled run from there.
+	"""
+	def __init__(self, workers=8):
+		self.workers = workers
+		self.jobs = queue.Queue()
+		self.results = queue.Queue()
+		self.threads = []
+		self.lock = threading.Lock()
+
+	def submit(self, fn, args=(), done=None, failed=None, progress=None):
+		job = Job(self, fn, args, done, failed, progress)
+		with self.lock:
+			while len(self.threads) < self.workers:
+				thread = threading.Thread(target=self.run)
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+		self.jobs.put(job)
+		return job
+
+	def run(self):
+		while True:
+			job = self.jobs.get()
+			if job.cancelled:
+				continue
+			try:
+				result = job.fn(job, *job.args)
+			except Cancelled:
+				continue
+			except Exception as e:
+				self.results.put((job, job.failed, e))
+			else:
+				self.results.put((job, job.done, result))
+
+	def poll(self):
+		while True:
+			try:
+				job, callback, value = self.results.get_nowait()
+			except queue.Empty:
+				return
+			if callback != None and not job.cancelled:
+				callback(value)
+
+class Prefetcher(object):
+	"""Fetches type 0 and 1 links ahead of time into the caches.
+
+	Runs at most limit requests at once on the given pool, and at most
+	per_host against any single server. Links already cached, or added
+	since the last clear(), are skipped.
+	"""
+	def __init__(self, pool, limit=3, per_host=1):
+		self.pool = pool
+		self.limit = limit
+		self.per_host = per_host
+		self.waiting = []
+		self.active = {}
+		self.jobs = {}
+		self.running = set()
+		self.seen = set()
+		self.selected = None
+		self.lock = threading.Lock()
+
+	def add(self, entry):
+		with self.lock:
+			self.queue(entry)
+
+	def select(self, entry):
+		"""Like add(), for the link under the cursor.
+
+		Only the last link passed here waits its turn; the one before,
+		if it hasn't started yet, is dropped, so moving through a long
+		menu doesn't queue up every link on the way.
+		"""
+		with self.lock:
+			if self.selected in self.waiting:
+				self.waiting.remove(self.selected)
+				self.seen.discard(self.selected[0])
+			self.selected = self.queue(entry)
+
+	def queue(self, entry):
+		# Called with the lock held; returns what was queued, if anything.
+		if len(entry) < 5 or entry[0] not in ("0", "1"):
+			return None
+		url = entry2url(entry)
+		if url in self.seen or url in cache or disk_cache.fetched(url) != None:
+			return None
+		self.seen.add(url)
+		item = (url, entry)
+		self.waiting.append(item)
+		self.start()
+		return item
+
+	def clear(self):
+		with self.lock:
+			del self.waiting[:]
+			for job, host in self.jobs.items():
+				job.cancel()
+				# The pool never runs a job cancelled before it starts,
+				# so its slot is given back here instead of in fetch().
+				if job not in self.running:
+					self.release(host)
+			self.jobs = {}
+			self.seen.clear()
+			self.selected = None
+
+	def start(self):
+		# Called with the lock held.
+		i = 0
+		while (i < len(self.waiting)
+				and sum(self.active.values()) < self.limit):
+			url, entry = self.waiting[i]
+			host = entry[3]
+			if self.active.get(host, 0) >= self.per_host:
+				i += 1
+				continue
+			del self.waiting[i]
+			self.active[host] = self.active.get(host, 0) + 1
+			job = self.pool.submit(self.fetch, (url, entry))
+			self.jobs[job] = host
+
+	def release(self, host):
+		# Called with the lock held.
+		self.active[host] -= 1
+		if self.active[host] == 0:
+			del self.active[host]
+
+	def fetch(self, job, url, entry):
+		with self.lock:
+			if job not in self.jobs:
+				# Cleared just as a worker picked it up; clear() has
+				# already given back the slot.
+				return
+			self.running.add(job)
+		trace = Trace(url)
+		try:
+			# Bodies stream straight into the disk cache, like the ones
+			# fetched for viewing; only menus are worth keeping parsed in
+			# memory as well.
+			tmp = disk_cache.temp_path(url)
+			try:
+				download(entry[2], entry[3], int(entry[4]), tmp,
+					job=job, trace=trace)
+				fn = disk_cache.commit(url, tmp)
+			except Exception:
+				if os.path.exists(tmp):
+					os.remove(tmp)
+				raise
+			if entry[0] == "1":
+				with open(fn, "rb") as f:
+					data = f.read()
+				started = time.time()
+				menu = parse_bytes(data)
+				trace.add("parse", time.time() - started)
+				cache.put(url, menu)
+			metrics.record(trace)
+		except Exception as e:
+			metrics.failed(trace, e)
+			raise
+		finally:
+			with self.lock:
+				self.running.discard(job)
+				self.jobs.pop(job, None)
+				self.release(entry[3])
+				self.start()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Gophersnake: stand-alone Gopher client for modern desktops
+# Copyright 2016-2018 Felix Pleșoianu <https://felix.plesoianu.ro/>
+#
+# Offered under the MIT License; see gophersnake.py or LICENSE for full text.
+#
+# Headless mirroring tool: walks a menu tree from a starting address and
+# saves menus (in the same format as "Save page as...") and files to disk.
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+
+import aiogopher
+from gopherlib import MenuParser, entry2url, url2entry
+from gopherlib import parse_file, write_to_file
+
+file_types = ("0", "4", "5", "6", "9", "g", "I", "s", "d")
+
+def clean_name(name):
+	name = re.sub(r'[\x00-\x1f<>:"\\|?*]', "_", name)
+	if name in ("", ".", ".."):
+		return "_"
+	return name
+
+class Mirror(object):
+	def __init__(self, root, out, jobs=8, depth=10, all_hosts=False,
+			timeout=None, per_host=2):
+		self.root = root
+		self.out = out
+		self.jobs = jobs
+		self.depth = depth
+		self.all_hosts = all_hosts
+		self.timeout = timeout
+		self.limiter = aiogopher.Limiter(jobs, per_host)
+		self.seen = set()
+		self.queue = None
+		self.menus = 0
+		self.files = 0
+		self.skipped = 0
+		self.failed = 0
+		self.received = 0
+		self.started = time.time()
+
+	def local_path(self, entry):
+		parts = [clean_name(entry[3] + "_" + entry[4])]
+		for i in entry[2].split("/"):
+			if i != "":
+				parts.append(clean_name(i))
+		if entry[0] == "1":
+			parts.append("gophermap")
+		elif len(parts) == 1:
+			parts.append("index")
+		return os.path.join(self.out, *parts)
+
+	def wanted(self, entry):
+		if len(entry) < 5 or entry[0] not in file_types + ("1",):
+			return False
+		elif self.all_hosts:
+			return True
+		return entry[3] == self.root[3] and entry[4] == self.root[4]
+
+	def add(self, entry, depth):
+		url = entry2url(entry)
+		if url not in self.seen:
+			self.seen.add(url)
+			self.queue.put_nowait((entry, depth))
+
+	async def run(self):
+		self.queue = asyncio.Queue()
+		self.add(self.root, 0)
+		workers = [asyncio.ensure_future(self.worker())
+			for i in range(self.jobs)]
+		reporter = asyncio.ensure_future(self.report_often())
+		await self.queue.join()
+		for i in workers + [reporter]:
+			i.cancel()
+		self.report()
+
+	async def worker(self):
+		while True:
+			entry, depth = await self.queue.get()
+			try:
+				if entry[0] == "1":
+					await self.get_menu(entry, depth)
+				else:
+					await self.get_file(entry)
+			except Exception as e:
+				self.failed += 1
+				print("failed: %s (%s)" % (entry2url(entry), e),
+					file=sys.stderr)
+			finally:
+				self.queue.task_done()
+
+	async def get_menu(self, entry, depth):
+		path = self.local_path(entry)
+		if os.path.exists(path):
+			entries = list(parse_file(path))
+			self.skipped += 1
+		else:
+			entries = []
+			parser = MenuParser()
+			async with self.limiter.slot(entry[3]):
+				async for i in aiogopher.fetch_stream(
+						entry[2], entry[3], entry[4], self.timeout):
+					self.received += len(i)
+					entries.extend(parser.feed(i))
+			entries.extend(parser.close())
+			# Many servers leave out the "." line, so a stream that ends
+			# without an error counts as the whole menu. It's written
+			# under another name first, so an interrupted run never
+			# leaves a partial menu that looks finished.
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			part = path + ".part"
+			# write_to_file wants exactly five fields per entry.
+			write_to_file(part,
+				[(tuple(e) + ("",) * 5)[:5] for e in entries])
+			os.replace(part, path)
+			self.menus += 1
+		if depth < self.depth:
+			for e in entries:
+				if self.wanted(e):
+					self.add(e, depth + 1)
+
+	async def get_file(self, entry):
+		path = self.local_path(entry)
+		if os.path.exists(path):
+			self.skipped += 1
+			return
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		part = path + ".part"
+		# Gopher can't start a transfer midway, so resuming means
+		# downloading again and only writing what's missing.
+		if os.path.exists(part):
+			skip = os.path.getsize(part)
+		else:
+			skip = 0
+		async with self.limiter.slot(entry[3]):
+			with open(part, "ab") as f:
+				async for i in aiogopher.fetch_stream(
+						entry[2], entry[3], entry[4], self.timeout):
+					self.received += len(i)
+					if skip >= len(i):
+						skip -= len(i)
+						continue
+					f.write(i[skip:])
+					skip = 0
+		os.replace(part, path)
+		self.files += 1
+
+	async def report_often(self):
+		while True:
+			await asyncio.sleep(5)
+			self.report()
+
+	def report(self):
+		elapsed = max(time.time() - self.started, 0.001)
+		print("%d menus, %d files, %d skipped, %d failed, %d queued; "
+			"%.1f MB in %.0f s (%.1f KB/s)" % (
+				self.menus, self.files, self.skipped, self.failed,
+				self.queue.qsize(), self.received / 1048576.0, elapsed,
+				self.received / 1024.0 / elapsed),
+			file=sys.stderr)
+
+def main(argv):
+	parser = argparse.ArgumentParser(
+		description="Mirror a Gopher menu tree to disk.")
+	parser.add_argument("url", help="gopher:// address to start from")
+	parser.add_argument("-o", "--output", default=".",
+		help="directory to save into (default: current)")
+	parser.add_argument("-j", "--jobs", type=int, default=8,
+		help="downloads to run at once (default: 8)")
+	parser.add_argument("-d", "--depth", type=int, default=10,
+		help="how many menus deep to go (default: 10)")
+	parser.add_argument("-a", "--all-hosts", action="store_true",
+		help="follow links to other servers too")
+	parser.add_argument("-p", "--per-host", type=int, default=2,
+		help="downloads to run at once from one server (default: 2)")
+	parser.add_argument("-t", "--timeout", type=float, default=None,
+		help="give up on any one request after this many seconds")
+	args = parser.parse_args(argv[1:])
+	try:
+		root = url2entry(args.url)
+	except ValueError as e:
+		parser.error(str(e))
+	mirror = Mirror(root, args.output, args.jobs, args.depth,
+		args.all_hosts, args.timeout, args.per_host)
+	asyncio.run(mirror.run())
+	return 1 if mirror.failed > 0 else 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Gophersnake: stand-alone Gopher client for modern desktops
+# Copyright 2016-2018 Felix Pleșoianu <https://felix.plesoianu.ro/>
+#
+# Offered under the MIT License; see gophersnake.py or LICENSE for full text.
+#
+# Caching proxy: a local Gopher server that passes every selector on to
+# one upstream server, shares the answers between all its clients, and
+# only asks upstream once when several clients want the same thing.
+
+import argparse
+import asyncio
+import sys
+import time
+
+import aiogopher
+from gopherlib import LRUCache, entry_types, url2entry
+
+class UpstreamError(Exception):
+	pass
+
+class Pending(object):
+	"""One upstream response, streamed to every client waiting on it.
+
+	Chunks are kept as they arrive so that clients joining late can
+	start from the beginning, until the response grows past keep_max
+	bytes; after that nobody else can join, and each client only holds
+	on to what it hasn't written out yet.
+	"""
+	def __init__(self, keep_max):
+		self.keep_max = keep_max
+		self.chunks = []
+		self.size = 0
+		self.queues = []
+		self.done = False
+		self.error = None
+
+	def joinable(self):
+		return self.chunks != None
+
+	def add(self, chunk):
+		self.size += len(chunk)
+		if self.chunks != None:
+			self.chunks.append(chunk)
+			if self.size > self.keep_max:
+				self.chunks = None
+		for q in self.queues:
+			q.put_nowait(chunk)
+
+	def finish(self, error=None):
+		self.done = True
+		self.error = error
+		for q in self.queues:
+			q.put_nowait(None)
+
+	def stream(self):
+		# What's here already, then whatever arrives after joining.
+		if self.done:
+			return self.follow(list(self.chunks), None)
+		q = asyncio.Queue()
+		self.queues.append(q)
+		return self.follow(list(self.chunks), q)
+
+	async def follow(self, backlog, q):
+		try:
+			for i in backlog:
+				yield i
+			while q != None:
+				chunk = await q.get()
+				if chunk == None:
+					break
+				yield chunk
+		finally:
+			if q != None:
+				self.queues.remove(q)
+		if self.error != None:
+			raise UpstreamError(str(self.error)
+				or self.error.__class__.__name__)
+
+class Rewriter(object):
+	"""Points menu links to the upstream server at the proxy instead.
+
+	Whether a response is a menu is decided from its first line; other
+	responses pass through untouched.
+	"""
+	def __init__(self, upstream, advertised):
+		self.old = (upstream[0].lower().encode(), str(upstream[1]).encode())
+		self.new = (advertised[0].encode(), str(advertised[1]).encode())
+		self.partial = b""
+		self.menu = None
+
+	def feed(self, chunk):
+		if self.menu == False:
+			return chunk
+		data = self.partial + chunk
+		end = data.rfind(b"\n") + 1
+		if end == 0:
+			self.partial = data
+			if len(data) > 65536:
+				self.menu = False
+				self.partial = b""
+				return data
+			return b""
+		self.partial = data[end:]
+		if self.menu == None:
+			self.menu = is_menu_line(data[:data.find(b"\n")])
+			if not self.menu:
+				self.partial = b""
+				return data
+		return b"\n".join(self.rewrite(i)
+			for i in data[:end - 1].split(b"\n")) + b"\n"
+
+	def close(self):
+		data = self.partial
+		self.partial = b""
+		if self.menu and data != b"":
+			return self.rewrite(data)
+		return data
+
+	def rewrite(self, line):
+		fields = line.split(b"\t")
+		if len(fields) < 4:
+			return line
+		port = fields[3].rstrip(b"\r")
+		if (fields[2].lower(), port) != self.old:
+			return line
+		fields[2] = self.new[0]
+		fields[3] = self.new[1] + fields[3][len(port):]
+		return b"\t".join(fields)
+
+def is_menu_line(line):
+	fields = line.rstrip(b"\r").split(b"\t")
+	return (len(fields) >= 4 and len(fields[0]) > 0
+		and fields[0][:1].decode("latin_1") in entry_types)
+
+class Proxy(object):
+	def __init__(self, upstream, jobs=32, timeout=None, ttl=300,
+			max_bytes=256 * 1024 * 1024, advertised=None):
+		self.upstream = upstream
+		self.timeout = timeout
+		self.ttl = ttl
+		self.advertised = advertised
+		self.limiter = aiogopher.Limiter(jobs)
+		self.cache = LRUCache(100000, max_bytes)
+		# Anything bigger than this is passed on but never cached.
+		self.keep_max = max(max_bytes // 16, 65536)
+		self.pending = {}
+		self.requests = 0
+		self.hits = 0
+		self.joined = 0
+		self.fetches = 0
+		self.failed = 0
+		self.received = 0
+		self.started = time.time()
+
+	async def serve(self, host, port):
+		server = await asyncio.start_server(self.handle, host, port)
+		reporter = asyncio.ensure_future(self.report_often())
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			reporter.cancel()
+
+	async def handle(self, reader, writer):
+		try:
+			line = await asyncio.wait_for(reader.readline(), 30)
+			# Kept as bytes, so selectors in any encoding pass unchanged.
+			selector = line.rstrip(b"\r\n")
+			self.requests += 1
+			started = False
+			try:
+				async for i in self.get(selector):
+					started = True
+					writer.write(i)
+					await writer.drain()
+			except UpstreamError as e:
+				self.failed += 1
+				if not started:
+					writer.write(error_menu("Upstream error: %s" % e))
+					await writer.drain()
+		except (OSError, ValueError, asyncio.TimeoutError):
+			# The client hung up, or never sent a proper request.
+			pass
+		finally:
+			writer.close()
+
+	def get(self, selector):
+		data = self.cache.get(selector)
+		if data != None:
+			self.hits += 1
+			return cached(data)
+		pending = self.pending.get(selector)
+		if pending != None and pending.joinable():
+			self.joined += 1
+		else:
+			pending = Pending(self.keep_max)
+			self.pending[selector] = pending
+			asyncio.ensure_future(self.fetch(selector, pending))
+		return pending.stream()
+
+	async def fetch(self, selector, pending):
+		# Runs on its own, so a client hanging up doesn't stop the
+		# others (or the cache) from getting the response.
+		self.fetches += 1
+		if self.advertised != None:
+			rewriter = Rewriter(self.upstream, self.advertised)
+		else:
+			rewriter = None
+		try:
+			async with self.limiter.slot(self.upstream[0]):
+				async for i in aiogopher.fetch_stream(selector,
+						self.upstream[0], self.upstream[1], self.timeout):
+					if rewriter != None:
+						i = rewriter.feed(i)
+					if i:
+						pending.add(i)
+			if rewriter != None:
+				i = rewriter.close()
+				if i:
+					pending.add(i)
+		except Exception as e:
+			pending.finish(e)
+		else:
+			if pending.joinable():
+				self.cache.put(selector, b"".join(pending.chunks),
+					pending.size, self.ttl)
+			pending.finish()
+		finally:
+			self.received += pending.size
+			if self.pending.get(selector) is pending:
+				del self.pending[selector]
+
+	async def report_often(self):
+		while True:
+			await asyncio.sleep(60)
+			self.report()
+
+	def report(self):
+		stats = self.cache.stats()
+		print("%d requests, %d from cache, %d joined, %d fetched, "
+			"%d failed; %.1f MB from upstream; cache %d items, %.1f MB" % (
+				self.requests, self.hits, self.joined, self.fetches,
+				self.failed, self.received / 1048576.0, stats["entries"],
+				stats["bytes"] / 1048576.0),
+			file=sys.stderr)
+
+async def cached(data):
+	yield data
+
+def error_menu(message):
+	return ("3%s\tfake\t(NULL)\t0\r\n.\r\n" % message).encode(
+		"utf-8", "replace")
+
+def parse_address(text, default_port):
+	host, _, port = text.rpartition(":")
+	if host == "":
+		return text, default_port
+	return host.strip("[]"), int(port)
+
+def main(argv):
+	parser = argparse.ArgumentParser(
+		description="Serve a Gopher server through a shared cache.")
+	parser.add_argument("url", help="gopher:// address of the upstream server")
+	parser.add_argument("-l", "--listen", default="127.0.0.1:7070",
+		help="address and port to listen on (default: 127.0.0.1:7070)")
+	parser.add_argument("-j", "--jobs", type=int, default=32,
+		help="upstream requests to run at once (default: 32)")
+	parser.add_argument("-c", "--cache-mb", type=int, default=256,
+		help="memory to use for cached responses (default: 256)")
+	parser.add_argument("--ttl", type=float, default=300,
+		help="seconds to serve a response from cache (default: 300)")
+	parser.add_argument("-t", "--timeout", type=float, default=None,
+		help="give up on any one upstream request after this many seconds")
+	parser.add_argument("-r", "--rewrite", metavar="HOST:PORT",
+		help="point menu links to the upstream server here instead")
+	args = parser.parse_args(argv[1:])
+	try:
+		root = url2entry(args.url)
+	except ValueError as e:
+		parser.error(str(e))
+	host, port = parse_address(args.listen, 7070)
+	if args.rewrite != None:
+		advertised = parse_address(args.rewrite, 70)
+	else:
+		advertised = None
+	proxy = Proxy((root[3], int(root[4])), args.jobs, args.timeout,
+		args.ttl, args.cache_mb * 1024 * 1024, advertised)
+	try:
+		asyncio.run(proxy.serve(host, port))
+	except KeyboardInterrupt:
+		proxy.report()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -24,41 +24,45 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from __future__ import print_function
-
+import difflib
+import hashlib
 import webbrowser
-import socket
-from threading import Thread
+import os
+import shutil
 import sys
+import tempfile
+import time
 from io import BytesIO
 
-if sys.version_info.major >= 3:
-	from urllib.parse import urlparse
-	
-	from tkinter import *
-	from tkinter import ttk
-	from tkinter.simpledialog import askstring
-	from tkinter.messagebox import showinfo, showerror
-	from tkinter.filedialog import askopenfilename, asksaveasfilename
-else:
-	from urlparse import urlparse
-	
-	from Tkinter import *
-	import ttk
-	from tkSimpleDialog import askstring
-	from tkMessageBox import showinfo, showerror
-	from tkFileDialog import askopenfilename, asksaveasfilename
+from gopherlib import entry_types, cache, disk_cache
+from gopherlib import entry2url, url2entry, parse_bytes, scheduler
+from gopherlib import MenuParser, Directory, WorkerPool, Cancelled
+from gopherlib import Prefetcher, Transfer, download, size_hint
+from gopherlib import parse_file, write_to_file
+from gopherlib import Snapshot, is_snapshot, write_snapshot
+from gopherlib import LRUCache, image_size
+from gopherlib import Trace, metrics
+from gopherindex import Index, index_file
+
+from urllib.parse import urlparse
+
+from tkinter import *
+from tkinter import ttk
+from tkinter.simpledialog import askstring, askinteger
+from tkinter.messagebox import showinfo, showerror, askyesno
+from tkinter.filedialog import askopenfilename, asksaveasfilename
+
+# Optional; without it only what Tk reads natively can be shown.
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
 
 about = """Gophersnake version 2016-08-29, running on Python %d.%d.%d
 Created by Felix Pleşoianu and offered under the MIT License.
 See the source code for full text.""" % (
 	sys.version_info.major, sys.version_info.minor, sys.version_info.micro)
 
-entry_types = {"0": "[TXT]", "1": "[DIR]", "2": "[CSO]", "3": "[ERR]",
-	"4": "[HEX]", "5": "[ARC]", "6": "[ENC]", "7": "[QRY]",
-	"8": "[TLN]", "9": "[BIN]", "g": "[GIF]", "h": "[HTM]",
-	"i": "", "I": "[IMG]", "s": "[SND]", "M": "MIME?", "d": "[PDF]"}
-
 icon_data = {}
 icon_data["Back"] = """
 R0lGODlhGAAYAIABAAAAAP///yH5BAEKAAEALAAAAAAYABgAAAJKjI+py+0GwHMxzlXjTTXEfVRG
@@ -111,98 +115,44 @@ home_dir = [('i', 'Welcome to Gophersnake, a simple client for the Gopher protoc
 	('h', "Author's website", 'URL:http://felix.plesoianu.ro/', '(NULL)', '0')]
 
 raw_data = b""
+# Digest of raw_data for network-loaded menus, to spot unchanged reloads.
+page_hash = None
 location = ""
 history = []
-dir_entries = []
-cache = {}
-
-def entry2url(e):
-	assert len(e) >= 5
-	#type label selector host port
-	if e[0] == "h" and e[2].startswith("URL:"):
-		return e[2][4:]
-	elif len(e) < 5:
-		return str(e)
-
-	if e[4] == "70":
-		port = ""
-	else:
-		port = ":" + str(e[4])
+dir_entries = Directory()
+# The Snapshot being shown, if any, so it can be closed afterwards.
+open_snapshot = None
 
-	if is_it_ipv6(e[3], port, True):
-		if (e[2] == ""):
-			return "gopher://%s%s" % (("["+e[3]+"]"), port)
-		else:
-			return "gopher://%s%s/%1s%s" % (
-				("["+e[3]+"]"), port, e[0], e[2])
-	else:
-		if e[2] == "":
-			return "gopher://%s%s" % (e[3], port)
-		else:
-			return "gopher://%s%s/%1s%s" % (e[3], port, e[0], e[2])
+pool = WorkerPool()
+nav_job = None
+back_pending = False
 
-def str2entry(line):
-	line = line.strip()
-	if len(line) == 0:
-		return None
-	elif len(line) == 1 and line[0] == ".":
-		return None
-	else:
-		return (line[0],) + tuple(line[1:].rstrip().split("\t"))
-
-def parse_bytes(data):
-	del dir_entries[:] #dir_entries.clear()
-	for i in data.decode(encoding="latin_1").split("\r\n"):
-		e = str2entry(i)
-		if e != None:
-			dir_entries.append(e)
-
-def parse_file(filename):
-	with open(filename, "r") as f:
-		for i in f:
-			yield (i[0],) + tuple(i[1:].rstrip().split("\t"))
-
-def write_to_file(filename, entries):
-	with open(filename, "w", newline="\r\n") as f:
-		for i in entries:
-			print("%s%s\t%s\t%s\t%s" % i, file=f)
-
-def is_it_ipv6(host, port, nodnslookup):
-	if nodnslookup:
-		try:
-			socket.inet_pton(socket.AF_INET6, str(host))
-		except socket.error:
-			return False
-		return True
-	else:
-		try:
-			socket.inet_pton(
-				socket.AF_INET6,
-				socket.getaddrinfo(host, port)[0][4][0])
-		except socket.error:
-			return False
-		return True
-
-def fetch_data(selector, host, port):
-	#global raw_data
-	if is_it_ipv6(host, port, False):
-	    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-	    sock.connect((host, port))
-	    sock.sendall((selector + "\r\n").encode())
-	else:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((host, port))
-            sock.sendall((selector + "\r\n").encode())
-	#raw_data = b""
-	data = sock.recv(1024)
-	while data:
-		#raw_data += data
-		yield data
-		data = sock.recv(1024)
-	
-	sock.shutdown(socket.SHUT_RDWR)
-	sock.close()
-	#yield False
+prefetcher = Prefetcher(pool)
+# How many links from the top of each page to fetch ahead of time.
+prefetch_count = 10
+# Decoded images by URL, so reopening one is instant; sizes count four
+# bytes for each pixel shown.
+images = LRUCache(100, 64 * 1024 * 1024)
+# Tk reads PNG from version 8.6 on.
+if TkVersion >= 8.6:
+	tk_formats = ("gif", "png", "ppm")
+else:
+	tk_formats = ("gif", "ppm")
+# Without PIL, larger images would have to be decoded at full size.
+max_image_pixels = 40 * 1000 * 1000
+
+# Seconds that search results are served from the cache.
+query_ttl = 120
+# Seconds between reloads of the current menu; 0 turns it off.
+auto_refresh = 0
+refresh_job = None
+# Largest changed region (old rows times new rows) worth a proper diff.
+diff_limit = 4000000
+
+# Loaded from disk at startup; saved on quit and every five minutes.
+index = Index()
+search_limit = 200
+index_autosave = 5 * 60 * 1000
 
 top = Tk()
 top.title("Gophersnake")
@@ -243,23 +193,36 @@ add_buttons(buttons2)
 main_menu = Menu(top, tearoff=0)
 main_menu.add_command(label="About...", underline=0,
 	command=lambda:show_about())
+main_menu.add_command(label="Request timings...", underline=8,
+	command=lambda: show_timings())
 main_menu.add_separator()
 main_menu.add_command(
 	label="Open as page...", underline=0, accelerator="Ctrl-O",
 	command=lambda: open_as_directory())
 main_menu.add_command(
 	label="View source...", underline=0, accelerator="Ctrl-U",
-	command=lambda: open_text_viewer(
-		location, raw_data.decode(encoding="latin_1")))
+	command=lambda: view_source())
 main_menu.add_command(
 	label="Save page as...", underline=0, accelerator="Ctrl-S",
 	command=lambda: save_directory_as())
+main_menu.add_command(
+	label="Search visited...", underline=2, accelerator="Ctrl-F",
+	command=lambda: ask_search())
+main_menu.add_separator()
+prefetch_links = BooleanVar()
+main_menu.add_checkbutton(
+	label="Prefetch links", underline=0, variable=prefetch_links,
+	command=lambda: prefetch_page())
+main_menu.add_command(
+	label="Auto-refresh...", underline=5,
+	command=lambda: ask_auto_refresh())
 main_menu.add_separator()
 main_menu.add_command(label="History", underline=0, state="disabled")
 main_menu.add_command(label="Bookmarks", underline=0, state="disabled")
 main_menu.add_separator()
 main_menu.add_command(
-	label="Quit", underline=0, accelerator="Ctrl-Q", command=top.destroy)
+	label="Quit", underline=0, accelerator="Ctrl-Q",
+	command=lambda: quit_client())
 
 menu_button = ttk.Menubutton(
 	toolbar, text="Menu", menu=main_menu)
@@ -309,10 +272,12 @@ top.bind("<Control-l>", lambda e: address_bar.focus())
 top.bind("<Control-r>", lambda e: reload_command(location))
 top.bind("<F5>", lambda e: reload_command(location))
 top.bind("<Control-o>", lambda e: open_as_directory())
-top.bind("<Control-u>",
-	lambda e: open_text_viewer(location, raw_data.decode()))
+top.bind("<Control-u>", lambda e: view_source())
 top.bind("<Control-s>", lambda e: save_directory_as())
-top.bind("<Control-q>", lambda e: top.destroy())
+top.bind("<Control-f>", lambda e: ask_search())
+top.bind("<Control-q>", lambda e: quit_client())
+top.protocol("WM_DELETE_WINDOW", lambda: quit_client())
+top.bind("<Escape>", lambda e: stop_loading())
 
 all_buttons["Back"]["state"] = "disabled"
 #all_buttons["Forward"]["state"] = "disabled"
@@ -333,10 +298,7 @@ def handle_entry(entry):
 	if entry[0] == "i":
 		pass
 	elif entry[0] == "0":
-		def load_fn():
-			load_with_status(entry, open_text_viewer)
-		load_op = Thread(None, load_fn)
-		load_op.start()
+		load_with_status(entry, open_text_viewer)
 	elif entry[0] == "1":
 		load_as_directory(entry)
 	elif entry[0] == "7":
@@ -346,24 +308,16 @@ def handle_entry(entry):
 			msg = "Search " + entry2url(entry) + " for:"
 		query = askstring("Gophersnake asks", msg, parent=top)
 		load_as_directory(entry, query)
-	elif entry[0] == "g":
-		# TO DO: open GIF files in own window.
-		def save_fn():
-			load_with_status(entry, open_image_viewer)
-			#save_with_status(entry[2], entry[3], int(entry[4]))
-		save_op = Thread(None, save_fn)
-		save_op.start()
+	elif entry[0] in ("g", "I"):
+		open_image(entry)
 	elif entry[0] == "h":
 		if entry[2].startswith("URL:"):
 			statusbar["text"] = "Opening in browser..."
 			webbrowser.open_new_tab(entry[2][4:])
 		else:
-			save_with_status(entry[2], entry[3], int(entry[4]))
-	elif entry[0] in ("5", "9", "I", "s", "d"):
-		def save_fn():
-			save_with_status(entry[2], entry[3], int(entry[4]))
-		save_op = Thread(None, save_fn)
-		save_op.start()
+			save_with_status(entry)
+	elif entry[0] in ("5", "9", "s", "d"):
+		save_with_status(entry)
 	else:
 		error = "Can't handle " + entry_types[entry[0]] + "."
 		showinfo(
@@ -373,17 +327,60 @@ def handle_entry(entry):
 
 def reload_command(text):
 	text = text.strip()
-	if text in cache:
-		del cache[text]
+	if text == location and is_menu_url(text):
+		refresh_page()
+		return
+	cache.discard(text)
+	disk_cache.discard(text)
 	handle_command(text)
 
+def is_menu_url(url):
+	try:
+		return url2entry(url)[0] == "1"
+	except ValueError:
+		return False
+
+def refresh_page(quiet=False):
+	"""Fetch the current menu again, redrawing only what changed."""
+	global nav_job
+	url = location
+	entry = url2entry(url)
+	trace = Trace(url)
+	stop_loading()
+	cache.discard(url)
+	disk_cache.discard(url)
+	
+	def reloaded(result):
+		global nav_job
+		nav_job = None
+		raw, entries = result
+		cache.put(url, entries)
+		if url == location:
+			update_directory(entries, raw, trace)
+	
+	def failed(e):
+		if quiet:
+			global nav_job
+			nav_job = None
+			statusbar["text"] = "Refresh failed: " + str(e)
+		else:
+			show_load_error(e)
+	
+	statusbar["text"] = "Reloading " + url + "..."
+	nav_job = pool.submit(
+		fetch_menu, (url, entry[2], entry[3], int(entry[4]), True, trace),
+		done=reloaded, failed=failed)
+
 def handle_command(text):
 	text = text.strip()
 	if text == "home":
-		if location != "home":
+		stop_loading()
+		if back_pending:
+			history.pop()
+		elif location != "home":
 			history.append(location)
-			all_buttons["Back"]["state"] = "enabled"
 		go_home()
+		update_back_button()
 	else:
 		handle_url(text)
 
@@ -392,28 +389,17 @@ def handle_url(url):
 	if parsed.scheme == "http" or parsed.scheme == "https":
 		webbrowser.open_new_tab(url)
 	elif parsed.scheme == "gopher":
-		if parsed.port == None:
-			port = 70
-		else:
-			port = str(parsed.port)
-
-		if parsed.path == "" or parsed.path == "/":
-			selector = ""
-			sel_type = "1"
-		elif parsed.path[0] == "/":
-			selector = parsed.path[1:]
-			if selector[0] in entry_types:
-				sel_type = selector[0]
-				selector = selector[1:]
-			else:
-				showerror(
-					parent=top,
-					title="Address bar error",
-					message="Unknown selector type.")
-				return
-				
-		entry = (sel_type, "", selector, parsed.hostname, port)
+		try:
+			entry = url2entry(url)
+		except ValueError as e:
+			showerror(
+				parent=top,
+				title="Address bar error",
+				message=str(e))
+			return
 		handle_entry(entry)
+	elif parsed.scheme == "search":
+		search_visited(url[len("search:"):])
 	elif parsed.scheme == "file":
 		if parsed.path != "":
 			handle_filename(parsed.path)
@@ -446,9 +432,11 @@ def update_status():
 		statusbar["text"] = ""
 	else:
 		statusbar["text"] = entry2url(entry)
+		if prefetch_links.get():
+			prefetcher.select(entry)
 
 def load_as_directory(entry, query=None):
-	global location
+	global nav_job
 	
 	if query != None:
 		selector = entry[2] + "\t" + query
@@ -456,153 +444,496 @@ def load_as_directory(entry, query=None):
 		selector = entry[2]
 	
 	url = entry2url(entry)
+	if query != None:
+		key = (url, query)
+	else:
+		key = url
+	back = back_pending
+	trace = Trace(url)
+	
+	stop_loading()
+	data = cache.get(key)
+	if data != None:
+		trace.cache = "memory"
+		show_directory(url, data, None, back, trace)
+		return
 	
-	# Can't use collections.OrderedDict here because it's Python 3.x only.
-	# Hopefully the RAM of a modern PC can hold the cache for one session.
-	if url in cache:
-		data = cache[url]
-		del dir_entries[:]
-		for i in data:
-			dir_entries.append(i)
-	elif load_raw_data(selector, entry[3], int(entry[4])):
-		parse_bytes(raw_data)
+	# Entries are shown as they arrive, in a page of their own until the
+	# complete menu comes back from the worker.
+	page = Directory()
+	
+	def partial(batch):
+		global dir_entries, raw_data
+		if len(page) == 0:
+			dir_entries = page
+			raw_data = None
+			visit(url, back)
+			show_entries(page)
+			address.set(location)
+		page.extend(batch)
+		if render_job == None:
+			show_entries(page, rendered)
+		if len(page) == len(batch):
+			select_first()
+	
+	def loaded(result):
+		raw, entries = result
 		if query == None:
-			cache[url] = []
-			for i in dir_entries:
-				cache[url].append(i)
+			cache.put(key, entries)
+		else:
+			cache.put(key, entries, ttl=query_ttl)
+		if len(page) > 0:
+			finish_directory(entries, raw, trace)
+		else:
+			show_directory(url, entries, raw, back, trace)
+	
+	statusbar["text"] = "Loading " + url + "..."
+	nav_job = pool.submit(
+		fetch_menu,
+		(url, selector, entry[3], int(entry[4]), query == None, trace),
+		done=loaded, failed=show_load_error, progress=partial)
+
+def show_directory(url, entries, raw, back=False, trace=None):
+	global dir_entries, raw_data, nav_job, page_hash
+	nav_job = None
+	dir_entries = entries
+	raw_data = raw
+	page_hash = digest(raw)
+	visit(url, back)
+	refresh_display(trace)
+	prefetch_page()
+
+def finish_directory(entries, raw, trace=None):
+	# The end of a menu that has been showing while it loaded.
+	global dir_entries, raw_data, nav_job, page_hash
+	nav_job = None
+	statusbar["text"] = ""
+	dir_entries = entries
+	raw_data = raw
+	page_hash = digest(raw)
+	show_entries(entries, rendered, trace)
+	prefetch_page()
+
+def digest(raw):
+	if raw == None:
+		return None
+	return hashlib.sha1(raw).hexdigest()
+
+def update_directory(entries, raw, trace=None):
+	# Swap in a reloaded version of the current page, touching only the
+	# rows that differ so that selection and scrolling stay put.
+	global dir_entries, raw_data, page_hash
+	new_hash = digest(raw)
+	if new_hash == page_hash:
+		raw_data = raw
+		statusbar["text"] = "No changes."
+		if trace != None:
+			metrics.record(trace)
+		return
+	old_entries = dir_entries
+	dir_entries = entries
+	raw_data = raw
+	page_hash = new_hash
+	if render_job != None:
+		show_entries(entries, 0, trace)
+		return
+	started = time.time()
+	count = update_rows(old_entries, entries)
+	if trace != None:
+		trace.add("render", time.time() - started)
+		metrics.record(trace)
+	statusbar["text"] = "%d rows changed." % count
+
+def update_rows(old, new):
+	global rendered
+	old = list(old)
+	new = list(new)
+	first = 0
+	limit = min(len(old), len(new))
+	while first < limit and old[first] == new[first]:
+		first += 1
+	old_end = len(old)
+	new_end = len(new)
+	while (old_end > first and new_end > first
+			and old[old_end - 1] == new[new_end - 1]):
+		old_end -= 1
+		new_end -= 1
+	old_rows = old[first:old_end]
+	new_rows = new[first:new_end]
+	if len(old_rows) * len(new_rows) <= diff_limit:
+		opcodes = difflib.SequenceMatcher(
+			None, old_rows, new_rows, False).get_opcodes()
 	else:
+		# Too big to diff quickly; compare row by row instead.
+		common = min(len(old_rows), len(new_rows))
+		opcodes = [("replace", 0, common, 0, common),
+			("replace", common, len(old_rows), common, len(new_rows))]
+	children = viewport.get_children()
+	selected = viewport.selection()
+	if len(selected) > 0:
+		selected_index = viewport.index(selected[0])
+	view = viewport.yview()[0]
+	count = 0
+	# Back to front, so earlier indexes stay valid.
+	for tag, i1, i2, j1, j2 in reversed(opcodes):
+		if tag == "equal":
+			continue
+		common = min(i2 - i1, j2 - j1)
+		for k in range(common):
+			if old_rows[i1 + k] != new_rows[j1 + k]:
+				values, tags = row_values(new_rows[j1 + k])
+				viewport.item(children[first + i1 + k],
+					values=values, tags=tags)
+				count += 1
+		if i2 - i1 > common:
+			viewport.delete(*children[first + i1 + common:first + i2])
+			count += i2 - i1 - common
+		for k in range(j1 + common, j2):
+			values, tags = row_values(new_rows[k])
+			viewport.insert("", first + i1 + k - j1,
+				values=values, tags=tags)
+			count += 1
+	rendered = len(new)
+	children = viewport.get_children()
+	if len(selected) > 0 and len(children) > 0:
+		if selected[0] not in children:
+			item = children[min(selected_index, len(children) - 1)]
+			viewport.selection_set(item)
+			viewport.focus(item)
+	viewport.yview_moveto(view)
+	return count
+
+def ask_auto_refresh():
+	global auto_refresh
+	seconds = askinteger("Gophersnake asks",
+		"Reload menus every how many seconds? (0 for never)",
+		parent=top, initialvalue=auto_refresh, minvalue=0)
+	if seconds != None:
+		auto_refresh = seconds
+		schedule_refresh()
+
+def schedule_refresh():
+	global refresh_job
+	if refresh_job != None:
+		top.after_cancel(refresh_job)
+		refresh_job = None
+	if auto_refresh > 0:
+		refresh_job = top.after(auto_refresh * 1000, auto_refresh_page)
+
+def auto_refresh_page():
+	global refresh_job
+	refresh_job = None
+	# Never interrupt a page the user is waiting on.
+	if nav_job == None and is_menu_url(location):
+		refresh_page(True)
+	schedule_refresh()
+
+def prefetch_page():
+	prefetcher.clear()
+	if not prefetch_links.get():
 		return
+	count = 0
+	for e in dir_entries:
+		if count >= prefetch_count:
+			break
+		elif len(e) >= 5 and e[0] in ("0", "1"):
+			prefetcher.add(e)
+			count += 1
 
-	history.append(location)
+def visit(url, back=False):
+	global location
+	if back:
+		history.pop()
+	else:
+		history.append(location)
 	location = url
-	refresh_display()
-	all_buttons["Back"]["state"] = "enabled"
+	update_back_button()
+
+def update_back_button():
+	if len(history) > 0:
+		all_buttons["Back"]["state"] = "enabled"
+	else:
+		all_buttons["Back"]["state"] = "disabled"
+
+def stop_loading():
+	global nav_job
+	if nav_job != None:
+		nav_job.cancel()
+		nav_job = None
+		statusbar["text"] = ""
+
+def show_load_error(e):
+	global nav_job
+	nav_job = None
+	statusbar["text"] = ""
+	showerror(
+		parent=top,
+		title="Error loading content",
+		message=str(e))
 
-def load_raw_data(selector, host, port):
-	global raw_data
-	data = b""
+# The fetch_* functions run on worker threads and must not touch Tk.
+
+def fetch_menu(job, url, selector, host, port, use_cache, trace):
+	# The trace is recorded once the menu is on screen, or here on error.
 	try:
-		for i in fetch_data(selector, host, port):
-			data += i
-		raw_data = data
-		return True
+		if use_cache:
+			data = disk_cache.get(url)
+			if data != None:
+				trace.cache = "disk"
+				started = time.time()
+				entries = parse_bytes(data)
+				trace.add("parse", time.time() - started)
+				return data, entries
+		chunks = []
+		entries = Directory()
+		parser = MenuParser()
+		for i in scheduler.fetch_data(
+				selector, host, port, job, trace=trace):
+			chunks.append(i)
+			started = time.time()
+			batch = parser.feed(i)
+			entries.extend(batch)
+			trace.add("parse", time.time() - started)
+			if len(batch) > 0:
+				job.report(batch)
+		batch = parser.close()
+		entries.extend(batch)
+		if len(batch) > 0:
+			job.report(batch)
 	except Exception as e:
-		showerror(
-			parent=top,
-			title="Error loading content",
-			message=str(e))
-		return False
+		metrics.failed(trace, e)
+		raise
+	data = b"".join(chunks)
+	if use_cache:
+		disk_cache.put(url, data)
+		# A job of its own, so the page doesn't wait for it.
+		pool.submit(lambda job: index.add_menu(url, entries))
+	return data, entries
 
-def load_with_status(entry, callback):
+def fetch_body(job, url, entry, transfer):
+	# Downloads go straight into the disk cache, or a temporary file if
+	# that can't be written, and viewers read them back from there.
+	try:
+		tmp = disk_cache.temp_path(url)
+		# Created here, so a cache folder that exists but can't be
+		# written to falls back as well.
+		open(tmp, "wb").close()
+	except OSError:
+		handle, tmp = tempfile.mkstemp(prefix="gophersnake-")
+		os.close(handle)
+	trace = Trace(url)
+	try:
+		download(entry[2], entry[3], int(entry[4]), tmp, transfer,
+			job.report, job=job, trace=trace)
+		job.check()
+	except Exception as e:
+		try:
+			os.remove(tmp)
+		except OSError:
+			pass
+		metrics.failed(trace, e)
+		raise
+	metrics.record(trace)
+	try:
+		fn = disk_cache.commit(url, tmp)
+	except OSError:
+		fn = tmp
+	if entry[0] == "0":
+		pool.submit(index_text, (entry, fn))
+	return fn
+
+def index_text(job, entry, fn):
+	try:
+		index.add_text(entry, fn)
+	except (OSError, IOError):
+		pass
+
+def fetch_to_file(job, fn, entry, transfer):
+	trace = Trace(entry2url(entry))
+	try:
+		download(entry[2], entry[3], int(entry[4]), fn, transfer,
+			job.report, job=job, trace=trace)
+		job.check()
+	except Exception as e:
+		metrics.failed(trace, e)
+		if isinstance(e, Cancelled):
+			os.remove(fn)
+		raise
+	metrics.record(trace)
+
+def progress_window(title, job, transfer):
 	prog_win = Toplevel(top, padx=8, pady=8)
-	prog_win.title = "Loading..."
+	prog_win.title(title)
 	prog_win.transient(top)
 	prog_win.resizable(FALSE, FALSE)
 	
-	prog_bar = ttk.Progressbar(
-		prog_win, orient=HORIZONTAL, length=300, mode="indeterminate")
+	if transfer.expected:
+		prog_bar = ttk.Progressbar(prog_win, orient=HORIZONTAL,
+			length=300, mode="determinate", maximum=transfer.expected)
+	else:
+		prog_bar = ttk.Progressbar(prog_win, orient=HORIZONTAL,
+			length=300, mode="indeterminate")
 	prog_bar.pack()
-
-	data = b""
-	try:
-		for i in fetch_data(entry[2], entry[3], int(entry[4])):
-			data += i
+	
+	prog_text = ttk.Label(prog_win, text="Connecting...")
+	prog_text.pack(side=LEFT, pady=(8, 0))
+	
+	def cancel():
+		job.cancel()
+		prog_win.destroy()
+	
+	def show_progress(transfer):
+		if transfer.expected:
+			prog_bar["value"] = min(transfer.received, transfer.expected)
+		else:
 			prog_bar.step()
-		callback(entry2url(entry), data)
-	except Exception as e:
+		prog_text["text"] = transfer.describe()
+	
+	cancel_button = ttk.Button(prog_win, text="Cancel", command=cancel)
+	cancel_button.pack(side=RIGHT, pady=(8, 0))
+	prog_win.protocol("WM_DELETE_WINDOW", cancel)
+	prog_win.bind("<Escape>", lambda e: cancel())
+	job.progress = show_progress
+	return prog_win
+
+def load_with_status(entry, callback):
+	url = entry2url(entry)
+	fn = disk_cache.fresh(url)
+	if fn != None:
+		metrics.record(Trace(url, "disk"))
+		callback(url, fn)
+		return
+	
+	def loaded(fn):
+		prog_win.destroy()
+		callback(url, fn)
+	
+	def failed(e):
+		prog_win.destroy()
 		showerror(
 			parent=top,
 			title="Error loading content",
 			message=str(e))
-	finally:
-		prog_win.destroy()
+	
+	transfer = Transfer(size_hint(entry[1]))
+	job = pool.submit(
+		fetch_body, (url, entry, transfer), done=loaded, failed=failed)
+	prog_win = progress_window("Loading...", job, transfer)
 
-def save_with_status(selector, host, port):
+def save_with_status(entry):
 	fn = asksaveasfilename(parent=top, title="Save file as")
 	if fn == "":
 		return
 	
-	prog_win = Toplevel(top, padx=8, pady=8)
-	prog_win.title = "Downloading..."
-	prog_win.transient(top)
-	prog_win.resizable(FALSE, FALSE)
-	
-	prog_bar = ttk.Progressbar(
-		prog_win, orient=HORIZONTAL, length=300, mode="indeterminate")
-	prog_bar.pack()
-	
-	try:
-		with open(fn, "wb") as f:
-			for i in fetch_data(selector, host, port):
-				f.write(i)
-				prog_bar.step()
-		return True
-	except Exception as e:
+	def failed(e):
+		prog_win.destroy()
 		showerror(
 			parent=top,
 			title="Error loading content",
 			message=str(e))
-		return False
-	finally:
-		prog_win.destroy()
+	
+	transfer = Transfer(size_hint(entry[1]))
+	job = pool.submit(
+		fetch_to_file, (fn, entry, transfer),
+		done=lambda result: prog_win.destroy(), failed=failed)
+	prog_win = progress_window("Downloading...", job, transfer)
 
-def show_entries(entries):
-	viewport.delete(*viewport.get_children())
-	for i in range(len(entries)):
+# Rows inserted per pass; the rest of a big menu follows in later passes,
+# so the window stays responsive and the first screen shows right away.
+render_batch = 500
+render_job = None
+# How many entries of the current page are in the viewport so far.
+rendered = 0
+
+def show_entries(entries, start=0, trace=None):
+	global render_job, rendered, open_snapshot
+	if render_job != None:
+		top.after_cancel(render_job)
+		render_job = None
+	started = time.time()
+	if start == 0:
+		viewport.delete(*viewport.get_children())
+		if open_snapshot is not entries:
+			if open_snapshot != None:
+				open_snapshot.close()
+			if isinstance(entries, Snapshot):
+				open_snapshot = entries
+			else:
+				open_snapshot = None
+	end = min(start + render_batch, len(entries))
+	for i in range(start, end):
 		e = entries[i]
 		if e == None:
 			continue
-		elif len(e) > 0 and e[0] in entry_types:
-			t = entry_types[e[0]]
-		else:
-			t = "[???]"
-		if len(e) > 1:
-			viewport.insert(
-				"", "end", values=(t, e[1]), tags=(e[0],))
-		else:
-			viewport.insert(
-				"", "end", values=(t, ""), tags=(e[0],))
+		values, tags = row_values(e)
+		viewport.insert("", "end", values=values, tags=tags)
+	rendered = end
+	if trace != None:
+		trace.add("render", time.time() - started)
+	if end < len(entries):
+		render_job = top.after(
+			1, lambda: show_entries(entries, end, trace))
+	elif trace != None:
+		metrics.record(trace)
+
+def row_values(e):
+	if len(e) > 0 and e[0] in entry_types:
+		t = entry_types[e[0]]
+	else:
+		t = "[???]"
+	if len(e) > 1:
+		return (t, e[1]), (e[0],)
+	else:
+		return (t, ""), (e[0],)
 
 def go_back():
+	global back_pending
 	if len(history) > 0:
-		handle_command(history.pop())
-		history.pop() # 'cause the entry will promptly add itself back.
-		if len(history) < 1:
-			all_buttons["Back"]["state"] = "disabled"
+		# The page only leaves history once it has actually loaded.
+		back_pending = True
+		try:
+			handle_command(history[-1])
+		finally:
+			back_pending = False
 
 def go_home():
-	global location, raw_data
-	#dir_entries.clear()
-	del dir_entries[:]
-	#for i in parse_file("home.txt"):
-	for i in home_dir:
-		dir_entries.append(i)
+	global location, raw_data, dir_entries
+	#dir_entries = Directory(parse_file("home.txt"))
+	dir_entries = Directory(home_dir)
 	location = "home"
 	raw_data = b""
 	refresh_display()
 
-def refresh_display():
-	show_entries(dir_entries)
+def refresh_display(trace=None):
+	show_entries(dir_entries, 0, trace)
 	address.set(location)
-	children = viewport.get_children()
-	if len(children) > 0:
-		viewport.selection_set(children[0])
-		viewport.focus(children[0])
-	else:
+	if len(viewport.get_children()) == 0:
 		showinfo(
 			parent=top,
 			title="Content issue",
 			message="Directory is empty.")
+	select_first()
+
+def select_first():
+	children = viewport.get_children()
+	if len(children) > 0:
+		viewport.selection_set(children[0])
+		viewport.focus(children[0])
 	viewport.focus_set()
 
-def open_text_viewer(url, data):
-	text = data.decode(encoding="latin_1")
-	
+# Bytes of text added to a viewer per pass, so long documents show their
+# first screen at once and fill in while the window stays responsive.
+text_chunk = 65536
+
+def open_text_viewer(url, fn):
+	f = open(fn, "rb")
+	show_text(url, iter(lambda: f.read(text_chunk), b""), f.close)
+
+def show_text(url, chunks, finished=None):
 	window = Toplevel(top)
 	window.title("Gophersnake text viewer")
 	
 	textview = Text(window, width=80, height=25, wrap="word")
-	textview.insert("1.0", text.replace("\r\n", "\n"))
 	window.bind("<Control-a>", lambda e: select_all())
 	textview.bind("<Control-c>", lambda e: copy_to_clipboard())
 	#textview["state"] = "disabled"
@@ -631,41 +962,265 @@ def open_text_viewer(url, data):
 	
 	window.rowconfigure(0, weight=1)
 	window.columnconfigure(0, weight=1)
+	
+	def insert_more(carry):
+		chunk = None
+		if window.winfo_exists():
+			chunk = next(chunks, None)
+		if chunk == None:
+			if finished != None:
+				finished()
+			return
+		# A CR at the end of a chunk may pair with an LF in the next one.
+		text = carry + str(chunk, "latin_1")
+		if text.endswith("\r"):
+			text, carry = text[:-1], "\r"
+		else:
+			carry = ""
+		textview.insert("end", text.replace("\r\n", "\n"))
+		top.after(1, insert_more, carry)
+	
+	insert_more("")
+
+class UnsupportedImage(ValueError):
+	pass
 
-# Broken as of 2016-08-29
-def open_image_viewer(url, bdata):
-	global img
-	stream = BytesIO(bdata)
-	img = PhotoImage(data=stream.read())
+def open_image(entry):
+	url = entry2url(entry)
+	image = images.get(url)
+	if image != None:
+		show_image(url, *image)
+	else:
+		load_with_status(entry, open_image_viewer)
+
+def open_image_viewer(url, fn):
+	# The header is checked, and with PIL the image decoded and scaled
+	# down, on a worker; Tk only gets something it can show as it is.
+	width = max(top.winfo_screenwidth() - 100, 100)
+	height = max(top.winfo_screenheight() - 150, 100)
 	
+	def prepared(result):
+		kind, source, factor, size = result
+		if kind == "file":
+			img = PhotoImage(file=source)
+			if factor > 1:
+				img = img.subsample(factor)
+		else:
+			img = PhotoImage(data=source, format="ppm")
+		if (img.width(), img.height()) != size:
+			info = "%dx%d, shown at %dx%d" % (
+				size + (img.width(), img.height()))
+		else:
+			info = "%dx%d" % size
+		images.put(url, (img, info), img.width() * img.height() * 4)
+		show_image(url, img, info)
+	
+	def failed(e):
+		if isinstance(e, UnsupportedImage):
+			if askyesno(parent=top, title="Image viewer",
+					message=str(e) + " Save it to a file instead?"):
+				save_copy(fn)
+		else:
+			showerror(
+				parent=top,
+				title="Error showing image",
+				message=str(e))
+	
+	pool.submit(prepare_image, (fn, width, height),
+		done=prepared, failed=failed)
+
+def prepare_image(job, fn, width, height):
+	kind, w, h = image_size(fn)
+	if kind == None:
+		factor = 1
+	else:
+		factor = max(-(-w // width), -(-h // height), 1)
+	if kind in tk_formats and factor == 1:
+		return ("file", fn, 1, (w, h))
+	elif Image != None:
+		image = Image.open(fn)
+		size = image.size
+		# Lets JPEG decode at a fraction of full size to begin with.
+		image.draft("RGB", (width, height))
+		image.thumbnail((width, height))
+		data = BytesIO()
+		image.convert("RGB").save(data, "PPM")
+		return ("data", data.getvalue(), 1, size)
+	elif kind in tk_formats:
+		if w * h > max_image_pixels:
+			raise UnsupportedImage(
+				"The image is too big to show (%dx%d)." % (w, h))
+		return ("file", fn, factor, (w, h))
+	else:
+		raise UnsupportedImage("Gophersnake can't show this image "
+			"without the Python Imaging Library (Pillow).")
+
+def show_image(url, img, info):
 	window = Toplevel(top)
 	window.title("Gophersnake image viewer")
+	# The window holds on to the image, which Tk drops once unreferenced.
+	window.image = img
 	
 	imgview = ttk.Label(window, image=img)
 	imgview.pack(side=TOP, fill="both", expand=TRUE)
 
-	imgstatus = ttk.Label(window, text=url)
+	imgstatus = ttk.Label(window, text=url + " (" + info + ")")
 	imgstatus.pack(side=BOTTOM, fill="x", expand=TRUE)
 
+def save_copy(fn):
+	target = asksaveasfilename(parent=top, title="Save file as")
+	if target == "":
+		return
+	try:
+		shutil.copyfile(fn, target)
+	except (OSError, IOError) as e:
+		showerror(
+			parent=top,
+			title="Error saving file",
+			message=str(e))
+
+def view_source():
+	if location.startswith("file://"):
+		fn = location[len("file://"):]
+	else:
+		fn = disk_cache.fresh(location, float("inf"))
+	if fn != None and os.path.exists(fn):
+		open_text_viewer(location, fn)
+	else:
+		# Search results never go to the disk cache.
+		data = raw_data or b""
+		show_text(location, (data[i:i + text_chunk]
+			for i in range(0, len(data), text_chunk)))
+
+def poll_jobs():
+	pool.poll()
+	top.after(50, poll_jobs)
+
 def show_about():
+	stats = cache.stats()
+	cache_info = "Cache: %d pages, %d KB, %d hits, %d misses." % (
+		stats["entries"], stats["bytes"] // 1024,
+		stats["hits"], stats["misses"])
+	stats = scheduler.stats()
+	fetch_info = "Requests: %d running, %d queued." % (
+		stats["running"], stats["waiting"])
+	summary = metrics.summary()
+	if summary["hit_ratio"] != None:
+		fetch_info += "\nCache hit ratio: %d%% of the last %d loads." % (
+			summary["hit_ratio"] * 100, summary["requests"])
 	showinfo(
 		parent=top,
 		title="About Gophersnake",
-		message=about)
+		message=about + "\n\n" + cache_info + "\n" + fetch_info)
+
+# Phases in the order a request goes through them.
+timing_phases = ("wait", "dns", "connect", "first_byte", "transfer",
+	"parse", "render")
+
+def format_timings(summary):
+	lines = ["%d requests, %d from cache, %d failed, %d KB received." % (
+		summary["requests"], summary["cache_hits"], summary["errors"],
+		summary["bytes"] // 1024), "",
+		"%-12s %6s %9s %9s %9s" % ("Phase", "Count", "p50 ms", "p90 ms",
+			"p99 ms")]
+	for phase in timing_phases:
+		if phase in summary["phases"]:
+			stats = summary["phases"][phase]
+			lines.append("%-12s %6d %9.1f %9.1f %9.1f" % (
+				phase, stats["count"], stats["p50"] * 1000,
+				stats["p90"] * 1000, stats["p99"] * 1000))
+	return "\n".join(lines)
+
+def show_timings():
+	window = Toplevel(top)
+	window.title("Gophersnake request timings")
+	text = Text(window, width=56, height=12, font="TkFixedFont")
+	text.pack(fill="both", expand=TRUE)
+	
+	def update():
+		if not window.winfo_exists():
+			return
+		text["state"] = "normal"
+		text.delete("1.0", "end")
+		text.insert("end", format_timings(metrics.summary()))
+		text["state"] = "disabled"
+		window.after(1000, update)
+	
+	update()
+
+def ask_search():
+	query = askstring("Gophersnake asks", "Search visited pages for:",
+		parent=top)
+	if query != None and query.strip() != "":
+		handle_command("search:" + query.strip())
+
+def search_visited(query):
+	global nav_job
+	back = back_pending
+	stop_loading()
+	
+	def found(results):
+		global dir_entries, raw_data, nav_job
+		nav_job = None
+		statusbar["text"] = ""
+		if len(results) > 0:
+			msg = "%d results for: %s" % (len(results), query)
+		else:
+			msg = "Nothing visited matches: " + query
+		dir_entries = Directory([("i", msg, "fake", "(NULL)", "0")])
+		dir_entries.extend(results)
+		raw_data = None
+		visit("search:" + query, back)
+		refresh_display()
+	
+	statusbar["text"] = "Searching..."
+	nav_job = pool.submit(lambda job: index.search(query, search_limit),
+		done=found, failed=show_load_error)
+
+def load_index():
+	global index
+	try:
+		index = Index.load(index_file())
+	except Exception:
+		index = Index()
+
+def save_index():
+	if index.dirty:
+		try:
+			index.save(index_file())
+		except (OSError, IOError):
+			pass
+
+def autosave_index():
+	pool.submit(lambda job: save_index())
+	top.after(index_autosave, autosave_index)
+
+def quit_client():
+	stop_loading()
+	save_index()
+	top.destroy()
+
+# Pages saved under this extension are written as binary snapshots,
+# which open instantly however long they are.
+snapshot_ext = ".gsnap"
+page_filetypes = [("All files", "*"), ("Menu snapshots", "*" + snapshot_ext)]
 
 def open_as_directory():
-	fn = askopenfilename(parent=top, title="Open as directory")
+	fn = askopenfilename(parent=top, title="Open as directory",
+		filetypes=page_filetypes)
 	if fn != "":
 		handle_filename(fn)
 
 def handle_filename(fn):
-	global location
+	global dir_entries, raw_data
+	stop_loading()
 	try:
-		del dir_entries[:]
-		for i in parse_file(fn):
-			dir_entries.append(i)
-		history.append(location)
-		location = "file://" + fn.replace("\\", "/")
+		if is_snapshot(fn):
+			dir_entries = Snapshot(fn)
+		else:
+			dir_entries = Directory(parse_file(fn))
+		raw_data = None
+		visit("file://" + fn.replace("\\", "/"), back_pending)
 		refresh_display()
 	except Exception as e:
 		showerror(
@@ -674,17 +1229,30 @@ def handle_filename(fn):
 			message=str(e))
 
 def save_directory_as():
-	fn = asksaveasfilename(parent=top, title="Save directory as")
+	fn = asksaveasfilename(parent=top, title="Save directory as",
+		filetypes=page_filetypes)
 	if fn == "":
 		return
 	try:
-		write_to_file(fn, dir_entries)
+		if fn.endswith(snapshot_ext):
+			write_snapshot(fn, dir_entries)
+		else:
+			write_to_file(fn, dir_entries)
 	except Exception as e:
 		showerror(
 			parent=top,
 			title="Error saving directory",
 			message=str(e))
 	
-go_home()
-
-top.mainloop()
+# Importing this module builds the window without running it, which the
+# benchmarks rely on; running it as a script starts the client proper.
+if __name__ == "__main__":
+	disk_cache.prune()
+	if os.environ.get("GOPHERSNAKE_TRACE"):
+		metrics.open_log(os.environ["GOPHERSNAKE_TRACE"])
+	load_index()
+	top.after(index_autosave, autosave_index)
+	go_home()
+	poll_jobs()
+	
+	top.mainloop()
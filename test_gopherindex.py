@@ -0,0 +1,63 @@
+# coding=utf-8
+#
+# Gophersnake: stand-alone Gopher client for modern desktops
+# Copyright 2016-2018 Felix Pleșoianu <https://felix.plesoianu.ro/>
+#
+# Offered under the MIT License; see gophersnake.py or LICENSE for full text.
+#
+# Run with "python -m unittest test_gopherindex".
+
+import unittest
+
+from gopherindex import Index
+
+class IndexTest(unittest.TestCase):
+	def test_menus_are_kept_apart(self):
+		index = Index()
+		index.add_menu("gopher://a.example/1/fruit", [
+			("i", "All about apples", "fake", "(NULL)", "0")])
+		index.add_menu("gopher://b.example:7070/1/more", [
+			("i", "All about bananas", "fake", "(NULL)", "0")])
+		apples = index.search("apples")
+		bananas = index.search("bananas")
+		self.assertEqual(apples, [("1", "gopher://a.example/1/fruit",
+			"/fruit", "a.example", "70")])
+		self.assertEqual(bananas, [("1", "gopher://b.example:7070/1/more",
+			"/more", "b.example", "7070")])
+
+	def test_common_terms_rank_candidates(self):
+		index = Index()
+		for i in range(200):
+			index.add(("0", "Doc", "/c%d" % i, "a.example", "70"),
+				["common"] * (1 + i % 3))
+		for i in range(3):
+			index.add(("0", "Doc", "/r%d" % i, "a.example", "70"),
+				["rare"] + ["common"] * i)
+		# With more candidates than the limit, "common" is only looked
+		# up for them, which mustn't change the top results.
+		self.assertEqual(index.search("rare common", 2),
+			index.search("rare common", 100)[:2])
+
+	def test_unchanged_menus_are_not_indexed_again(self):
+		index = Index()
+		menu = [("i", "All about apples", "fake", "(NULL)", "0"),
+			("0", "Recipes", "/recipes", "a.example", "70")]
+		for i in range(10):
+			index.add_menu("gopher://a.example/1/fruit", menu)
+		self.assertEqual(len(index.docs), 2)
+		self.assertEqual(len(index.deleted), 0)
+
+	def test_compact_drops_old_versions(self):
+		index = Index()
+		for i in range(5):
+			index.add_menu("gopher://a.example/1/news", [
+				("i", "Issue %d" % i, "fake", "(NULL)", "0")])
+		self.assertEqual(len(index.deleted), 4)
+		index.compact()
+		self.assertEqual(len(index.docs), 1)
+		self.assertEqual(index.search("issue 4"), [("1",
+			"gopher://a.example/1/news", "/news", "a.example", "70")])
+		self.assertEqual(index.search("3"), [])
+
+if __name__ == "__main__":
+	unittest.main()